@@ -17,31 +17,51 @@ class Arcfour(object):
     '1021bf0420'
     >>> Arcfour('Secret').process('Attack at dawn').encode('hex')
     '45a01f645fc35b383552544b9bf5'
+    >>> rc4 = Arcfour('Key')
+    >>> rc4.copy().process('Plain').encode('hex')
+    'bbf316e8d9'
+    >>> rc4.process('Plaintext').encode('hex')
+    'bbf316e8d940af0ad3'
     """
 
     def __init__(self, key):
         s = range(256)
         j = 0
         klen = len(key)
+        key = map(ord, key)
         for i in xrange(256):
-            j = (j + s[i] + ord(key[i % klen])) % 256
+            j = (j + s[i] + key[i % klen]) & 255
             (s[i], s[j]) = (s[j], s[i])
         self.s = s
         (self.i, self.j) = (0, 0)
         return
 
+    def copy(self):
+        """Returns an independent copy of the current state.
+
+        Copying a key-scheduled object is much cheaper than
+        scheduling the same key again.
+        """
+        rc4 = object.__new__(Arcfour)
+        rc4.s = self.s[:]
+        (rc4.i, rc4.j) = (self.i, self.j)
+        return rc4
+
     def process(self, data):
         (i, j) = (self.i, self.j)
         s = self.s
-        r = ''
-        for c in data:
-            i = (i+1) % 256
-            j = (j+s[i]) % 256
-            (s[i], s[j]) = (s[j], s[i])
-            k = s[(s[i]+s[j]) % 256]
-            r += chr(ord(c) ^ k)
+        # XOR the key stream into a mutable copy of the whole buffer.
+        r = bytearray(data)
+        for n in xrange(len(r)):
+            i = (i+1) & 255
+            si = s[i]
+            j = (j+si) & 255
+            sj = s[j]
+            s[i] = sj
+            s[j] = si
+            r[n] ^= s[(si+sj) & 255]
         (self.i, self.j) = (i, j)
-        return r
+        return str(r)
 
 # test
 if __name__ == '__main__':
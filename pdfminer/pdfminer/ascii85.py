@@ -28,29 +28,41 @@ def ascii85decode(data):
     >>> ascii85decode('E,9)oF*2M7/c~>')
     'pleasure.'
     """
+    return ''.join(iter_ascii85decode([data]))
+
+# iter_ascii85decode(chunks)
+def iter_ascii85decode(chunks):
+    """
+    Decodes an iterable of ASCII85 strings incrementally.
+    A group of five letters may span several chunks.
+
+    >>> list(iter_ascii85decode(['E,9)oF', '*2M7/c~>']))
+    ['plea', 'sure.']
+    """
     n = b = 0
-    out = ''
-    for c in data:
-        if '!' <= c and c <= 'u':
-            n += 1
-            b = b*85+(ord(c)-33)
-            if n == 5:
-                out += struct.pack('>L',b)
-                n = b = 0
-        elif c == 'z':
-            assert n == 0
-            out += '\0\0\0\0'
-        elif c == '~':
-            if n:
-                for _ in range(5-n):
-                    b = b*85+84
-                out += struct.pack('>L',b)[:n-1]
-            break
-    return out
+    for data in chunks:
+        out = []
+        for c in data:
+            if '!' <= c and c <= 'u':
+                n += 1
+                b = b*85+(ord(c)-33)
+                if n == 5:
+                    out.append(struct.pack('>L',b))
+                    n = b = 0
+            elif c == 'z':
+                assert n == 0
+                out.append('\0\0\0\0')
+            elif c == '~':
+                if n:
+                    for _ in range(5-n):
+                        b = b*85+84
+                    out.append(struct.pack('>L',b)[:n-1])
+                yield ''.join(out)
+                return
+        yield ''.join(out)
+    return
 
 # asciihexdecode(data)
-hex_re = re.compile(r'([a-f\d]{2})', re.IGNORECASE)
-trail_re = re.compile(r'^(?:[a-f\d]{2}|\s)*([a-f\d])[\s>]*$', re.IGNORECASE)
 def asciihexdecode(data):
     """
     ASCIIHexDecode filter: PDFReference v1.4 section 3.3.1
@@ -68,13 +80,31 @@ def asciihexdecode(data):
     >>> asciihexdecode('7>')
     'p'
     """
-    decode = (lambda hx: chr(int(hx, 16)))
-    out = map(decode, hex_re.findall(data))
-    m = trail_re.search(data)
-    if m:
-        out.append(decode("%c0" % m.group(1)))
-    return ''.join(out)
+    return ''.join(iter_asciihexdecode([data]))
 
+# iter_asciihexdecode(chunks)
+nonhex_re = re.compile(r'[^a-f\d]+', re.IGNORECASE)
+def iter_asciihexdecode(chunks):
+    """
+    Decodes an iterable of ASCIIHex strings incrementally.
+    Characters other than hexadecimal digits are ignored.
+
+    >>> list(iter_asciihexdecode(['6 16', '2 7>']))
+    ['a', 'b', 'p']
+    """
+    carry = ''
+    for data in chunks:
+        eod = data.find('>')
+        if 0 <= eod:
+            data = data[:eod]
+        data = carry+nonhex_re.sub('', data)
+        n = len(data) & ~1
+        carry = data[n:]
+        yield data[:n].decode('hex')
+        if 0 <= eod: break
+    if carry:
+        yield (carry+'0').decode('hex')
+    return
 
 if __name__ == '__main__':
     import doctest
@@ -1,27 +1,48 @@
 #!/usr/bin/env python
 import sys, os.path
+import weakref
 from pdfdevice import PDFDevice, PDFTextDevice
+from pdfinterp import PDFResourceManager, PDFPageInterpreter
+from pdfinterp import open_document, iter_pages
 from pdffont import PDFUnicodeNotDefined
 from pdftypes import LITERALS_DCT_DECODE
 from pdfcolor import LITERAL_DEVICE_GRAY, LITERAL_DEVICE_RGB
 from layout import LTContainer, LTPage, LTText, LTLine, LTRect, LTPolygon
 from layout import LTFigure, LTImage, LTChar, LTTextLine, LTTextBox, LTTextGroup
-from utils import apply_matrix_pt, mult_matrix
-from utils import enc, bbox2str, create_bmp
+from utils import apply_matrix_pt, mult_matrix, LRUCache
+from utils import enc, bbox2str, create_bmp_header
 
 
 ##  PDFPageAggregator
 ##
 class PDFPageAggregator(PDFTextDevice):
 
+    # marked contents are not part of the layout.
+    want_tags = False
+
+    # The figures of Form XObjects are kept and reused when the same form
+    # is drawn again with the same matrix, except for the translation.
+    # They are kept only while the pages of the same document are
+    # processed.
+    FIGURES_MAXENTRIES = 100
+
     def __init__(self, rsrc, pageno=1, laparams=None):
         PDFTextDevice.__init__(self, rsrc)
         self.laparams = laparams
         self.pageno = pageno
         self.stack = []
+        # figures: {(objid, linear part of the matrix, laparams): figure}
+        self.figures = LRUCache(maxentries=self.FIGURES_MAXENTRIES)
+        # figkeys: the keys of the figures being built (or None).
+        self.figkeys = []
+        # a weak reference to the document of the figures.
+        self.docref = None
         return
 
     def begin_page(self, page, ctm):
+        if self.docref is None or self.docref() is not page.doc:
+            self.docref = weakref.ref(page.doc)
+            self.figures.clear()
         (x0,y0,x1,y1) = page.mediabox
         (x0,y0) = apply_matrix_pt(ctm, (x0,y0))
         (x1,y1) = apply_matrix_pt(ctm, (x1,y1))
@@ -35,18 +56,57 @@ class PDFPageAggregator(PDFTextDevice):
         self.cur_item.fixate()
         self.cur_item.analyze(self.laparams)
         self.pageno += 1
-        return self.cur_item
+        # the device does not keep the page once it is returned.
+        (page, self.cur_item) = (self.cur_item, None)
+        return page
+
+    def skip_page(self, page, ctm):
+        self.pageno += 1
+        return
+
+    def get_state(self):
+        return self.pageno
+
+    def set_state(self, state):
+        self.pageno = state
+        return
 
     def begin_figure(self, name, bbox, matrix):
         self.stack.append(self.cur_item)
         self.cur_item = LTFigure(name, bbox, mult_matrix(matrix, self.ctm))
+        self.figkeys.append(None)
         return
 
+    def reuse_figure(self, xobj):
+        fig = self.cur_item
+        assert isinstance(fig, LTFigure)
+        if xobj.objid is None: return False
+        key = (xobj.objid, fig.matrix[:4], self.laparams)
+        try:
+            cached = self.figures[key]
+        except KeyError:
+            # store the figure when it is done.
+            self.figkeys[-1] = key
+            return False
+        # the same layout only moved.
+        obj = cached.translate(fig.matrix[4]-cached.matrix[4], fig.matrix[5]-cached.matrix[5])
+        fig.objs = obj.objs
+        if hasattr(obj, 'layout'):
+            fig.layout = obj.layout
+        # the objects have been analyzed already.
+        self.figkeys[-1] = False
+        return True
+
     def end_figure(self, _):
         fig = self.cur_item
         assert isinstance(self.cur_item, LTFigure)
+        key = self.figkeys.pop()
         self.cur_item.fixate()
-        self.cur_item.analyze(self.laparams)
+        if key is not False:
+            self.cur_item.analyze(self.laparams)
+        if key:
+            # keep a copy so that the figure in the page can be modified.
+            self.figures[key] = fig.translate(0, 0)
         self.cur_item = self.stack.pop()
         self.cur_item.add(fig)
         return
@@ -96,6 +156,25 @@ class PDFPageAggregator(PDFTextDevice):
         return item.adv
 
 
+# iter_layout(fp, pagenos=None, laparams=None, maxpages=0,
+#             password='', cachedir=None, rsrc=None)
+#   Yields the LTPage of each page as soon as it is analyzed.
+#   The pages are read and analyzed lazily, and no reference to
+#   a page is kept once it is yielded, so the pages that are done
+#   with can be freed and the iteration can be stopped at any point.
+def iter_layout(fp, pagenos=None, laparams=None, maxpages=0,
+                password='', cachedir=None, rsrc=None):
+    if rsrc is None:
+        rsrc = PDFResourceManager()
+    doc = open_document(fp, password, cachedir)
+    device = PDFPageAggregator(rsrc, laparams=laparams)
+    interpreter = PDFPageInterpreter(rsrc, device)
+    for (_,page) in iter_pages(doc, pagenos, maxpages):
+        yield interpreter.process_page(page)
+    device.close()
+    return
+
+
 ##  PDFConverter
 ##
 class PDFConverter(PDFPageAggregator):
@@ -113,31 +192,55 @@ class PDFConverter(PDFPageAggregator):
     def write_image(self, image):
         stream = image.stream
         filters = stream.get_filters()
+        bits = None
         if len(filters) == 1 and filters[0] in LITERALS_DCT_DECODE:
             ext = '.jpg'
-            data = stream.get_rawdata()
-        elif stream.colorspace is LITERAL_DEVICE_RGB:
+            chunks = stream.iter_rawdata()
+        elif image.colorspace[0] is LITERAL_DEVICE_RGB:
             ext = '.bmp'
-            data = create_bmp(stream.get_data(), stream.bits*3, image.width, image.height)
-        elif stream.colorspace is LITERAL_DEVICE_GRAY:
+            bits = image.bits*3
+            chunks = stream.iter_data()
+        elif image.colorspace[0] is LITERAL_DEVICE_GRAY:
             ext = '.bmp'
-            data = create_bmp(stream.get_data(), stream.bits, image.width, image.height)
+            bits = image.bits
+            chunks = stream.iter_data()
         else:
             ext = '.img'
-            data = stream.get_data()
+            chunks = stream.iter_data()
         name = image.name+ext
         path = os.path.join(self.outdir, name)
+        # the data is written chunk by chunk without being
+        # held in memory as a whole.
+        (width, height) = image.srcsize
         fp = file(path, 'wb')
-        fp.write(data)
-        fp.close()
+        try:
+            if bits is not None:
+                # the header is rewritten when the data size is known.
+                fp.write(create_bmp_header(0, bits, width, height))
+            size = 0
+            for data in chunks:
+                fp.write(data)
+                size += len(data)
+            if bits is not None:
+                fp.seek(0)
+                fp.write(create_bmp_header(size, bits, width, height))
+            fp.close()
+        except:
+            # do not leave a partial file.
+            fp.close()
+            os.remove(path)
+            raise
         return name
-        return
     
 
 ##  TextConverter
 ##
 class TextConverter(PDFConverter):
 
+    # only the texts are written.
+    want_paths = False
+    want_images = False
+
     def __init__(self, rsrc, outfp, codec='utf-8', pageno=1, laparams=None,
                  showpageno=False):
         PDFConverter.__init__(self, rsrc, outfp, codec=codec, pageno=pageno, laparams=laparams)
@@ -183,6 +286,23 @@ class HTMLConverter(PDFConverter):
         self.yoffset = self.pagepad
         return
 
+    def skip_page(self, page, ctm):
+        # the page is placed below the previous one. (see begin_page)
+        (x0,y0,x1,y1) = page.mediabox
+        (_,y0) = apply_matrix_pt(ctm, (x0,y0))
+        (_,y1) = apply_matrix_pt(ctm, (x1,y1))
+        self.yoffset += abs(y0-y1) + self.pagepad
+        PDFConverter.skip_page(self, page, ctm)
+        return
+
+    def get_state(self):
+        return (PDFConverter.get_state(self), self.yoffset)
+
+    def set_state(self, (state, yoffset)):
+        PDFConverter.set_state(self, state)
+        self.yoffset = yoffset
+        return
+
     def write_rect(self, color, width, x, y, w, h):
         self.outfp.write('<span style="position:absolute; border: %s %dpx solid; '
                          'left:%dpx; top:%dpx; width:%dpx; height:%dpx;"></span>\n' %
@@ -349,6 +469,9 @@ class XMLConverter(PDFConverter):
 ##
 class TagExtractor(PDFDevice):
 
+    want_paths = False
+    want_images = False
+
     def __init__(self, rsrc, outfp, codec='utf-8'):
         PDFDevice.__init__(self, rsrc)
         self.outfp = outfp
@@ -382,6 +505,17 @@ class TagExtractor(PDFDevice):
         self.pageno += 1
         return
 
+    def skip_page(self, page, ctm):
+        self.pageno += 1
+        return
+
+    def get_state(self):
+        return self.pageno
+
+    def set_state(self, state):
+        self.pageno = state
+        return
+
     def begin_tag(self, tag, props=None):
         s = ''
         if props:
@@ -73,6 +73,13 @@ class LTItem(object):
     def __repr__(self):
         return ('<item bbox=%s>' % bbox2str(self.bbox))
 
+    def translate(self, dx, dy):
+        """Returns a copy of the item moved by (dx,dy)."""
+        obj = self.__class__.__new__(self.__class__)
+        obj.__dict__.update(self.__dict__)
+        obj.set_bbox((self.x0+dx, self.y0+dy, self.x1+dx, self.y1+dy))
+        return obj
+
     def set_bbox(self, (x0,y0,x1,y1)):
         if x1 < x0: (x0,x1) = (x1,x0)
         if y1 < y0: (y0,y1) = (y1,y0)
@@ -132,6 +139,11 @@ class LTPolygon(LTItem):
         self.linewidth = linewidth
         return
 
+    def translate(self, dx, dy):
+        obj = LTItem.translate(self, dx, dy)
+        obj.pts = [ (x+dx, y+dy) for (x,y) in self.pts ]
+        return obj
+
     def get_pts(self):
         return ','.join( '%.3f,%.3f' % p for p in self.pts )
 
@@ -187,6 +199,9 @@ class LTText(object):
     def __repr__(self):
         return '<text %r>' % self.text
 
+    def translate(self, dx, dy):
+        return self
+
     def is_upright(self):
         return True
 
@@ -246,6 +261,12 @@ class LTChar(LTItem, LTText):
         else:
             return '<char %r>' % self.text
 
+    def translate(self, dx, dy):
+        obj = LTItem.translate(self, dx, dy)
+        (a,b,c,d,e,f) = self.matrix
+        obj.matrix = (a,b,c,d,e+dx,f+dy)
+        return obj
+
     def get_size(self):
         return max(self.width, self.height)
 
@@ -282,6 +303,11 @@ class LTContainer(LTItem):
         self.objs.append(obj)
         return
 
+    def translate(self, dx, dy):
+        obj = LTItem.translate(self, dx, dy)
+        obj.objs = [ x.translate(dx, dy) for x in self.objs ]
+        return obj
+
     def merge(self, container):
         self.objs.extend(container.objs)
         return
@@ -581,6 +607,23 @@ class LTAnalyzer(LTContainer):
         self.layout = top
         return
 
+    def translate(self, dx, dy):
+        obj = LTContainer.translate(self, dx, dy)
+        layout = getattr(self, 'layout', None)
+        if layout is not None:
+            # the layout tree refers to the text boxes in objs.
+            boxes = dict( (id(x), y) for (x,y) in zip(self.objs, obj.objs) )
+            def move(item):
+                if id(item) in boxes:
+                    return boxes[id(item)]
+                if not isinstance(item, LTTextGroup):
+                    return item.translate(dx, dy)
+                group = LTItem.translate(item, dx, dy)
+                group.objs = [ move(x) for x in item.objs ]
+                return group
+            obj.layout = move(layout)
+        return obj
+
     def get_textobjs(self):
         """Split all the objects in the page into text-related objects and others."""
         textobjs = []
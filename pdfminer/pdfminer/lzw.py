@@ -94,8 +94,86 @@ def lzwdecode(data):
     >>> lzwdecode('\x80\x0b\x60\x50\x22\x0c\x0c\x85\x01')
     '\x2d\x2d\x2d\x2d\x2d\x41\x2d\x2d\x2d\x42'
     """
-    fp = StringIO(data)
-    return ''.join(LZWDecoder(fp).run())
+    return ''.join(iter_lzwdecode([data]))
+
+# iter_lzwdecode
+def iter_lzwdecode(chunks, bufsize=65536, early=1):
+    """
+    Decodes an iterable of LZW-encoded strings incrementally.
+    The output is yielded in chunks of about bufsize bytes.
+    early is the EarlyChange parameter: when it is 1, the code length
+    is increased one code earlier than the table is filled up.
+
+    >>> list(iter_lzwdecode(['\x80\x0b\x60\x50', '\x22\x0c\x0c\x85\x01'], 4))
+    ['-----', 'A---', 'B']
+    >>> list(iter_lzwdecode(['\x80\x0b\x60\x50\x22\x0c\x0c\x85\x01'], early=0))
+    ['-----A---B']
+
+    Unlike LZWDecoder, the input is read through a bit accumulator
+    and the string table is allocated once, which is several times faster.
+    Decoding stops at the EOD code or at an invalid code.
+    """
+    # the string table. entries after nextcode are reused after a reset.
+    table = [ chr(c) for c in xrange(256) ] + [None]*(4096-256)
+    nextcode = 258
+    nbits = 9
+    # the code that increases the code length.
+    limit = 512-early
+    prev = None
+    # bit accumulator.
+    bitbuf = 0
+    nbuf = 0
+    out = []
+    size = 0
+    for data in chunks:
+        for c in bytearray(data):
+            bitbuf = (bitbuf << 8) | c
+            nbuf += 8
+            if nbuf < nbits: continue
+            # a code is at most 12 bits long, so each byte
+            # completes at most one code.
+            nbuf -= nbits
+            code = bitbuf >> nbuf
+            bitbuf &= (1 << nbuf)-1
+            if code < 256:
+                x = table[code]
+            elif code == 256:
+                # clear table
+                nextcode = 258
+                nbits = 9
+                limit = 512-early
+                prev = None
+                continue
+            elif code == 257:
+                # EOD
+                if out:
+                    yield ''.join(out)
+                return
+            elif code < nextcode:
+                x = table[code]
+            elif code == nextcode and prev is not None:
+                x = prev + prev[0]
+            else:
+                # invalid code.
+                if out:
+                    yield ''.join(out)
+                return
+            if prev is not None and nextcode < 4096:
+                table[nextcode] = prev + x[0]
+                nextcode += 1
+                if nextcode == limit and nbits < 12:
+                    nbits += 1
+                    limit = (limit+early)*2-early
+            prev = x
+            out.append(x)
+            size += len(x)
+            if bufsize <= size:
+                yield ''.join(out)
+                out = []
+                size = 0
+    if out:
+        yield ''.join(out)
+    return
 
 if __name__ == '__main__':
     import doctest
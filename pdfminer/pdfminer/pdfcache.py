@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+""" On-disk cache of document indexes.
+
+Opening a large PDF file requires locating and reading all of its
+XRef sections and walking the page tree. When the same file is
+processed many times, this work can be saved in a cache directory
+and reused by later runs.
+
+Each cache file holds a compact index of one document:
+the merged XRef table (including object stream membership),
+the trailers, and the page objids with their inherited attributes.
+A cache file is identified by the size of the document and a hash
+of its first and last blocks; the modification time is also
+checked when the cache is loaded. A stale, corrupt or otherwise
+unusable cache file is simply ignored and rebuilt.
+
+"""
+
+import sys
+import os
+import os.path
+import marshal
+import tempfile
+from array import array
+try:
+    import hashlib as md5
+except ImportError:
+    import md5
+from psparser import PSLiteral, LIT
+from pdftypes import PDFException, PDFObjRef
+
+
+class PDFCacheError(PDFException): pass
+
+
+##  Encoding PDF objects
+##
+##  PDF objects are converted into a nested structure of basic types
+##  that can be marshaled. Object references and literals are encoded
+##  as tagged tuples; PDF objects never contain a tuple by themselves.
+##
+def encode_obj(x):
+    '''Converts a PDF object into a marshallable structure.'''
+    if x is None or isinstance(x, (bool, int, long, float, str)):
+        return x
+    if isinstance(x, list):
+        return [ encode_obj(v) for v in x ]
+    if isinstance(x, dict):
+        return dict( (k, encode_obj(v)) for (k,v) in x.iteritems() )
+    if isinstance(x, PDFObjRef):
+        return ('R', x.objid)
+    if isinstance(x, PSLiteral):
+        return ('L', x.name)
+    raise PDFCacheError('Cannot encode: %r' % x)
+
+def decode_obj(doc, x):
+    '''Reconstructs a PDF object encoded by encode_obj.'''
+    if isinstance(x, list):
+        return [ decode_obj(doc, v) for v in x ]
+    if isinstance(x, dict):
+        return dict( (k, decode_obj(doc, v)) for (k,v) in x.iteritems() )
+    if isinstance(x, tuple):
+        (tag, v) = x
+        if tag == 'R':
+            return PDFObjRef(doc, v, 0)
+        if tag == 'L':
+            return LIT(v)
+        raise PDFCacheError('Invalid tag: %r' % tag)
+    return x
+
+
+##  PDFIndexCache
+##
+class PDFIndexCache(object):
+
+    """A directory that stores the indexes of PDF documents.
+
+    Typical usage:
+      cache = PDFIndexCache(cachedir)
+      entry = cache.load(parser)
+      if entry is None:
+        entry = (build the index)
+        cache.save(parser, entry)
+
+    An entry is a dictionary of marshallable values.
+    """
+
+    debug = 0
+
+    MAGIC = 'pdfminer-index'
+    # Increment this when the format of entries is changed.
+    VERSION = 1
+    # Size of the blocks at the both ends of a file that are hashed.
+    HASH_BLOCK = 65536
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        return
+
+    def __repr__(self):
+        return '<PDFIndexCache: %r>' % self.cachedir
+
+    def get_fileinfo(self, parser):
+        '''Returns (size, mtime, digest) of the file read by the parser.'''
+        if parser.data is not None:
+            size = len(parser.data)
+            mtime = 0
+        else:
+            try:
+                st = os.fstat(parser.fp.fileno())
+            except (AttributeError, IOError, OSError):
+                return None
+            size = st.st_size
+            mtime = int(st.st_mtime)
+        hash = md5.md5(str(size))
+        hash.update(parser.fetch(0, self.HASH_BLOCK))
+        if self.HASH_BLOCK < size:
+            hash.update(parser.fetch(max(self.HASH_BLOCK, size-self.HASH_BLOCK), self.HASH_BLOCK))
+        return (size, mtime, hash.hexdigest())
+
+    def get_path(self, digest):
+        return os.path.join(self.cachedir, digest+'.idx')
+
+    def load(self, parser):
+        '''Returns the cached entry for the file, or None.'''
+        info = self.get_fileinfo(parser)
+        if info is None: return None
+        path = self.get_path(info[2])
+        try:
+            fp = file(path, 'rb')
+            try:
+                data = fp.read()
+            finally:
+                fp.close()
+        except IOError:
+            return None
+        try:
+            (magic, version, itemsize, size, mtime, digest, checksum, payload) = marshal.loads(data)
+            if (magic, version, itemsize) != (self.MAGIC, self.VERSION, array('L').itemsize):
+                raise PDFCacheError('Incompatible cache: %r' % path)
+            if (size, mtime, digest) != info:
+                raise PDFCacheError('Stale cache: %r' % path)
+            if md5.md5(payload).digest() != checksum:
+                raise PDFCacheError('Corrupt cache: %r' % path)
+            entry = marshal.loads(payload)
+            if not isinstance(entry, dict):
+                raise PDFCacheError('Corrupt cache: %r' % path)
+        except (PDFCacheError, ValueError, EOFError, TypeError), e:
+            if self.debug:
+                print >>sys.stderr, 'cache: %s' % e
+            return None
+        if self.debug:
+            print >>sys.stderr, 'cache: loaded %r' % path
+        return entry
+
+    def save(self, parser, entry):
+        '''Stores the entry for the file. Returns True if succeeded.'''
+        info = self.get_fileinfo(parser)
+        if info is None: return False
+        (size, mtime, digest) = info
+        path = self.get_path(digest)
+        try:
+            payload = marshal.dumps(entry)
+        except ValueError, e:
+            if self.debug:
+                print >>sys.stderr, 'cache: %s' % e
+            return False
+        data = marshal.dumps((self.MAGIC, self.VERSION, array('L').itemsize,
+                              size, mtime, digest, md5.md5(payload).digest(), payload))
+        try:
+            if not os.path.isdir(self.cachedir):
+                os.makedirs(self.cachedir)
+            # Write to a temporary file first so that
+            # a concurrent reader never sees a partial file.
+            (fd, tmppath) = tempfile.mkstemp(suffix='.tmp', dir=self.cachedir)
+            fp = os.fdopen(fd, 'wb')
+            try:
+                fp.write(data)
+            finally:
+                fp.close()
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(tmppath, path)
+        except (IOError, OSError), e:
+            if self.debug:
+                print >>sys.stderr, 'cache: %s' % e
+            return False
+        if self.debug:
+            print >>sys.stderr, 'cache: saved %r' % path
+        return True
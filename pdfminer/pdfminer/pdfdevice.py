@@ -11,6 +11,15 @@ class PDFDevice(object):
 
     debug = 0
 
+    # The kinds of contents that the device consumes.
+    # The interpreter does not build the contents that are not
+    # consumed: texts (render_string), paths (paint_path),
+    # images (render_image) and marked contents (*_tag).
+    want_text = True
+    want_paths = True
+    want_images = True
+    want_tags = True
+
     def __init__(self, rsrc):
         self.rsrc = rsrc
         self.ctm = None
@@ -37,10 +46,29 @@ class PDFDevice(object):
         return
     def end_page(self, page):
         return
+    # skip_page(page, ctm)
+    #   Called instead of begin_page() and end_page() for a page that
+    #   is rendered by another device (see pdfparallel). The device
+    #   only updates the states that are carried over to the next page.
+    def skip_page(self, page, ctm):
+        return
+    # get_state(), set_state(state)
+    #   Returns or restores the states carried over from page to page,
+    #   such as the page number. The state must be picklable.
+    def get_state(self):
+        return None
+    def set_state(self, state):
+        return
     def begin_figure(self, name, bbox, matrix):
         return
     def end_figure(self, name):
         return
+    # reuse_figure(xobj)
+    #   Called after begin_figure() for a Form XObject. Returns True if
+    #   the device has restored the contents of the figure by itself,
+    #   in which case the form is not interpreted.
+    def reuse_figure(self, xobj):
+        return False
 
     def paint_path(self, graphicstate, stroke, fill, evenodd, path):
         return
@@ -329,6 +329,14 @@ LITERAL_STANDARD_ENCODING = LIT('StandardEncoding')
 LITERAL_TYPE1C = LIT('Type1C')
 
 
+# parse_unicode_map(data)
+#   Returns the unicode map of the data of a ToUnicode stream.
+def parse_unicode_map(data):
+    unicode_map = FileUnicodeMap()
+    CMapParser(unicode_map, StringIO(data)).run()
+    return unicode_map
+
+
 # PDFFont
 class PDFFont(object):
 
@@ -383,7 +391,7 @@ class PDFFont(object):
 # PDFSimpleFont
 class PDFSimpleFont(PDFFont):
 
-    def __init__(self, descriptor, widths, spec):
+    def __init__(self, descriptor, widths, spec, rsrc=None):
         # Font encoding is specified either by a name of
         # built-in encoding or a dictionary that describes
         # the differences.
@@ -400,8 +408,10 @@ class PDFSimpleFont(PDFFont):
         self.unicode_map = None
         if 'ToUnicode' in spec:
             strm = stream_value(spec['ToUnicode'])
-            self.unicode_map = FileUnicodeMap()
-            CMapParser(self.unicode_map, StringIO(strm.get_data())).run()
+            if rsrc is None:
+                self.unicode_map = parse_unicode_map(strm.get_data())
+            else:
+                self.unicode_map = rsrc.get_unicode_map(strm)
         PDFFont.__init__(self, descriptor, widths)
         return
 
@@ -434,7 +444,7 @@ class PDFType1Font(PDFSimpleFont):
             lastchar = int_value(spec.get('LastChar', 255))
             widths = list_value(spec.get('Widths', [0]*256))
             widths = dict( (i+firstchar,w) for (i,w) in enumerate(widths) )
-        PDFSimpleFont.__init__(self, descriptor, widths, spec)
+        PDFSimpleFont.__init__(self, descriptor, widths, spec, rsrc)
         return
 
     def __repr__(self):
@@ -459,7 +469,7 @@ class PDFType3Font(PDFSimpleFont):
         else:
             descriptor = {'Ascent':0, 'Descent':0,
                           'FontBBox':spec['FontBBox']}
-        PDFSimpleFont.__init__(self, descriptor, widths, spec)
+        PDFSimpleFont.__init__(self, descriptor, widths, spec, rsrc)
         self.matrix = tuple(list_value(spec.get('FontMatrix')))
         (_,self.descent,_,self.ascent) = self.bbox
         (self.hscale,self.vscale) = apply_matrix_norm(self.matrix, (1,1))
@@ -508,8 +518,10 @@ class PDFCIDFont(PDFFont):
         self.unicode_map = None
         if 'ToUnicode' in spec:
             strm = stream_value(spec['ToUnicode'])
-            self.unicode_map = FileUnicodeMap()
-            CMapParser(self.unicode_map, StringIO(strm.get_data())).run()
+            if rsrc is None:
+                self.unicode_map = parse_unicode_map(strm.get_data())
+            else:
+                self.unicode_map = rsrc.get_unicode_map(strm)
         elif self.cidcoding == 'Adobe-Identity':
             if ttf:
                 try:
@@ -1,30 +1,31 @@
 #!/usr/bin/env python
 import re
+import weakref
 from sys import stderr
-from struct import pack, unpack
 try:
-    from cStringIO import StringIO
+    import hashlib as md5
 except ImportError:
-    from StringIO import StringIO
+    import md5
+from struct import pack, unpack
 from cmapdb import CMapDB, CMap
 from psparser import PSException, PSTypeError, PSEOF
 from psparser import PSKeyword, literal_name, keyword_name
 from psparser import PSStackParser
 from psparser import LIT, KWD, STRICT
 from pdftypes import PDFException, PDFStream, PDFObjRef
-from pdftypes import resolve1
+from pdftypes import resolve1, estimate_size, digest_obj
 from pdftypes import int_value, float_value, num_value
 from pdftypes import str_value, list_value, dict_value, stream_value
 from pdffont import PDFFontError
 from pdffont import PDFType1Font, PDFTrueTypeFont, PDFType3Font
-from pdffont import PDFCIDFont
+from pdffont import PDFCIDFont, parse_unicode_map
 from pdfparser import PDFDocument, PDFParser
 from pdfparser import PDFPasswordIncorrect
 from pdfcolor import PDFColorSpace
 from pdfcolor import PREDEFINED_COLORSPACE
 from pdfcolor import LITERAL_DEVICE_GRAY, LITERAL_DEVICE_RGB
 from pdfcolor import LITERAL_DEVICE_CMYK
-from utils import choplist
+from utils import choplist, LRUCache
 from utils import mult_matrix, MATRIX_IDENTITY
 
 
@@ -128,13 +129,79 @@ class PDFResourceManager(object):
     ResourceManager facilitates reuse of shared resources
     such as fonts and images so that large objects are not
     allocated multiple times.
+
+    It also keeps the compiled programs of Form XObjects
+    (see compile_contents) in an LRUCache bounded by PROGRAMS_MAXBYTES
+    and PROGRAMS_MAXENTRIES. The programs are keyed by objid and
+    belong to the current document (see set_document).
+
+    Fonts are kept in an LRUCache bounded by FONTS_MAXENTRIES and
+    keyed by objid. Like the programs, they belong to the current
+    document, so a manager can be used for more than one document.
+
+    If sharedcache is given (an LRUCache or any object with the same
+    interface), the fonts and the ToUnicode maps are also looked up
+    by the digest of their contents (see digest_obj), so that the same
+    font in different documents is created only once. The cache can
+    be shared by many managers. This is the only cache that spans
+    documents; a font in it may keep its document in memory until
+    it is evicted. get_stats() returns the statistics of the caches.
     '''
     debug = 0
 
-    def __init__(self):
-        self.fonts = {}
+    PROGRAMS_MAXBYTES = 16*1024*1024
+    PROGRAMS_MAXENTRIES = 1000
+    FONTS_MAXENTRIES = 1000
+
+    def __init__(self, sharedcache=None):
+        self.fonts = LRUCache(maxentries=self.FONTS_MAXENTRIES)
+        self.sharedcache = sharedcache
+        self.programs = LRUCache(maxentries=self.PROGRAMS_MAXENTRIES,
+                                 maxbytes=self.PROGRAMS_MAXBYTES, sizefunc=estimate_size)
+        # a weak reference to the current document.
+        self.docref = None
+        return
+
+    # set_document(doc)
+    #   Tells the document whose pages are processed. When it differs
+    #   from the previous one, the caches that belong to a document
+    #   are cleared, so that they neither mix objects of different
+    #   documents nor keep a finished document in memory.
+    def set_document(self, doc):
+        if self.docref is not None and self.docref() is doc: return
+        self.docref = weakref.ref(doc)
+        self.fonts.clear()
+        self.programs.clear()
         return
 
+    def get_stats(self):
+        stats = {'fonts': self.fonts.get_stats(),
+                 'programs': self.programs.get_stats()}
+        if self.sharedcache is not None:
+            stats['shared'] = self.sharedcache.get_stats()
+        return stats
+
+    # get_program(strm, images=True)
+    #   Returns the compiled program of a content stream of
+    #   the current document. A stream is compiled when it is
+    #   executed the second time, so None is returned for the first
+    #   time. A program without inline images is kept separately.
+    def get_program(self, strm, images=True):
+        key = (strm.objid, images)
+        try:
+            program = self.programs[key]
+        except KeyError:
+            # mark the stream as seen.
+            self.programs[key] = None
+            return None
+        if program is None:
+            program = compile_contents([strm], images=images)
+            self.programs[key] = program
+            # the program includes the inline images,
+            # so the decoded data is no longer needed.
+            strm.uncache()
+        return program
+
     def get_procset(self, procs):
         for proc in procs:
             if proc is LITERAL_PDF:
@@ -153,10 +220,37 @@ class PDFResourceManager(object):
             if strict: raise
             return CMap()
 
-    def get_font(self, objid, spec):
-        if objid and objid in self.fonts:
-            font = self.fonts[objid]
-        else:
+    # get_unicode_map(strm)
+    #   Returns the unicode map of a ToUnicode stream.
+    def get_unicode_map(self, strm):
+        data = strm.get_data()
+        if self.sharedcache is None:
+            return parse_unicode_map(data)
+        key = ('ToUnicode', md5.md5(data).digest())
+        try:
+            return self.sharedcache[key]
+        except KeyError:
+            pass
+        unicode_map = parse_unicode_map(data)
+        self.sharedcache[key] = unicode_map
+        return unicode_map
+
+    # get_font(objid, spec, doc=None)
+    #   Returns the font of a font dictionary of a document.
+    #   If doc is given, it becomes the current document.
+    def get_font(self, objid, spec, doc=None):
+        if doc is not None:
+            self.set_document(doc)
+        font = None
+        if objid:
+            key = objid
+            font = self.fonts.get(key)
+            if font is not None:
+                return font
+            if self.sharedcache is not None:
+                digest = ('Font', digest_obj(spec))
+                font = self.sharedcache.get(digest)
+        if font is None:
             if STRICT:
                 if spec['Type'] is not LITERAL_FONT:
                     raise PDFFontError('Type is not /Font')
@@ -192,8 +286,10 @@ class PDFResourceManager(object):
                 if STRICT:
                     raise PDFFontError('Invalid Font spec: %r' % spec)
                 font = PDFType1Font(self, spec) # this is so wrong!
-            if objid:
-                self.fonts[objid] = font
+            if objid and self.sharedcache is not None:
+                self.sharedcache[digest] = font
+        if objid:
+            self.fonts[key] = font
         return font
 
 
@@ -201,39 +297,62 @@ class PDFResourceManager(object):
 ##
 class PDFContentParser(PSStackParser):
 
-    def __init__(self, streams):
+    """
+    PDFContentParser tokenizes the decoded data of the content
+    streams one after another. The data is read in chunks so that
+    a large stream is never held in memory as a whole.
+    Positions are offsets in the concatenation of the streams.
+    If images is False, the data of inline images are skipped
+    and neither the images nor their EI operators are returned.
+    """
+
+    BUFSIZ = 65536
+
+    def __init__(self, streams, images=True):
         self.streams = streams
-        self.istream = 0
+        self.images = images
+        self.chunks = self.iter_chunks()
+        self.buf = ''
+        self.bufpos = 0
         PSStackParser.__init__(self, None)
         return
 
-    def fillfp(self):
-        if not self.fp:
-            if self.istream < len(self.streams):
-                strm = stream_value(self.streams[self.istream])
-                self.istream += 1
-            else:
-                raise PSEOF('Unexpected EOF, file truncated?')
-            self.fp = StringIO(strm.get_data())
+    def iter_chunks(self):
+        for strm in self.streams:
+            for data in stream_value(strm).iter_data(self.BUFSIZ):
+                yield data
+            # the data of a stream ends exactly at its /Length, so the
+            # last token is terminated here and is not joined to the next.
+            yield '\n'
         return
 
     def seek(self, pos):
-        self.fillfp()
-        PSStackParser.seek(self, pos)
+        # the data is read only forward.
+        # the position must not precede the current buffer.
+        assert self.bufpos <= pos, (self.bufpos, pos)
+        self.charpos = pos-self.bufpos
+        self._reset_tokenizer()
+        self.reset()
         return
 
     def fillbuf(self):
         if self.charpos < len(self.buf): return
+        # the current chunk is exhausted. proceed to the next one.
         while 1:
-            self.fillfp()
-            self.bufpos = self.fp.tell()
-            self.buf = self.fp.read(self.BUFSIZ)
-            if self.buf: break
-            self.fp = None
-        self.charpos = 0
+            try:
+                data = self.chunks.next()
+            except StopIteration:
+                raise PSEOF('Unexpected EOF, file truncated?')
+            self.charpos -= len(self.buf)
+            self.bufpos += len(self.buf)
+            self.buf = data
+            if self.charpos < len(self.buf): break
         return
 
-    def get_inline_data(self, pos, target='EI'):
+    # get_inline_data(pos, target='EI', keep=True)
+    #   Reads the data of an inline image up to the target.
+    #   If keep is False, the data is skipped and None is returned.
+    def get_inline_data(self, pos, target='EI', keep=True):
         self.seek(pos)
         i = 0
         data = ''
@@ -241,7 +360,8 @@ class PDFContentParser(PSStackParser):
             self.fillbuf()
             if i:
                 c = self.buf[self.charpos]
-                data += c
+                if keep:
+                    data += c
                 self.charpos += 1
                 if len(target) <= i and c.isspace():
                     i += 1
@@ -253,12 +373,16 @@ class PDFContentParser(PSStackParser):
                 try:
                     j = self.buf.index(target[0], self.charpos)
                     #print 'found', (0, self.buf[j:j+10])
-                    data += self.buf[self.charpos:j+1]
+                    if keep:
+                        data += self.buf[self.charpos:j+1]
                     self.charpos = j+1
                     i = 1
                 except ValueError:
-                    data += self.buf[self.charpos:]
+                    if keep:
+                        data += self.buf[self.charpos:]
                     self.charpos = len(self.buf)
+        if not keep:
+            return (pos, None)
         data = data[:-(len(target)+1)] # strip the last part
         data = re.sub(r'(\x0d\x0a|[\x0d\x0a])', '', data)
         return (pos, data)
@@ -267,6 +391,9 @@ class PDFContentParser(PSStackParser):
         self.add_results(*self.popall())
         return
 
+    # the data of an inline image is read by get_inline_data().
+    REGEX_STOPWORDS = frozenset(['ID'])
+
     KEYWORD_BI = KWD('BI')
     KEYWORD_ID = KWD('ID')
     KEYWORD_EI = KWD('EI')
@@ -277,6 +404,9 @@ class PDFContentParser(PSStackParser):
         elif token is self.KEYWORD_ID:
             try:
                 (_, objs) = self.end_type('inline')
+                if not self.images:
+                    self.get_inline_data(pos+len('ID '), keep=False)
+                    return
                 if len(objs) % 2 != 0:
                     raise PSTypeError('Invalid dictionary construct: %r' % objs)
                 d = dict( (literal_name(k), v) for (k,v) in choplist(2, objs) )
@@ -291,15 +421,69 @@ class PDFContentParser(PSStackParser):
         return
 
 
+# iter_instructions(streams, images=True)
+#   Parses content streams and yields a list of (operator, operands).
+#   The operands of each operator are the objects that precede it.
+#   If images is False, inline images are omitted.
+def iter_instructions(streams, images=True):
+    try:
+        parser = PDFContentParser(streams, images=images)
+    except PSEOF:
+        # empty page
+        return
+    nextobject = parser.nextobject
+    operands = []
+    while 1:
+        try:
+            (_,obj) = nextobject()
+        except PSEOF:
+            break
+        if isinstance(obj, PSKeyword):
+            yield (obj, operands)
+            operands = []
+        else:
+            operands.append(obj)
+    return
+
+# compile_contents(streams, images=True)
+#   Returns the program of content streams, a list of
+#   instructions that can be replayed by PDFPageInterpreter.
+def compile_contents(streams, images=True):
+    return list(iter_instructions(streams, images=images))
+
+
 ##  Interpreter
 ##
 class PDFPageInterpreter(object):
 
     debug = 0
 
+    # The operators that are ignored when the device does not
+    # consume the kind of contents (see PDFDevice.want_*).
+    TEXT_OPERATORS = ('do_BT', 'do_ET', 'do_Tc', 'do_Tw', 'do_Tz', 'do_TL', 'do_Tf',
+                      'do_Tr', 'do_Ts', 'do_Td', 'do_TD', 'do_Tm', 'do_T_a',
+                      'do_TJ', 'do_Tj', 'do__q', 'do__w')
+    PATH_OPERATORS = ('do_m', 'do_l', 'do_c', 'do_v', 'do_y', 'do_h', 'do_re',
+                      'do_S', 'do_s', 'do_f', 'do_F', 'do_f_a', 'do_B', 'do_B_a',
+                      'do_b', 'do_b_a', 'do_n')
+    IMAGE_OPERATORS = ('do_EI',)
+    TAG_OPERATORS = ('do_MP', 'do_DP', 'do_BMC', 'do_BDC', 'do_EMC')
+
     def __init__(self, rsrc, device):
         self.rsrc = rsrc
         self.device = device
+        # optable: {PSKeyword: (bound method, nargs)}
+        self.optable = {}
+        # ignored: the names of the operators that are not executed.
+        self.ignored = set()
+        if not device.want_text:
+            self.ignored.update(self.TEXT_OPERATORS)
+        if not device.want_paths:
+            self.ignored.update(self.PATH_OPERATORS)
+        if not device.want_images:
+            self.ignored.update(self.IMAGE_OPERATORS)
+        if not device.want_tags:
+            self.ignored.update(self.TAG_OPERATORS)
         return
 
     def dup(self):
@@ -327,12 +511,13 @@ class PDFPageInterpreter(object):
             if 1 <= self.debug:
                 print >>stderr, 'Resource: %r: %r' % (k,v)
             if k == 'Font':
+                if not self.device.want_text: continue
                 for (fontid,spec) in dict_value(v).iteritems():
-                    objid = None
+                    (objid, doc) = (None, None)
                     if isinstance(spec, PDFObjRef):
-                        objid = spec.objid
+                        (objid, doc) = (spec.objid, spec.doc)
                     spec = dict_value(spec)
-                    self.fontmap[fontid] = self.rsrc.get_font(objid, spec)
+                    self.fontmap[fontid] = self.rsrc.get_font(objid, spec, doc)
             elif k == 'ColorSpace':
                 for (csid,spec) in dict_value(v).iteritems():
                     self.csmap[csid] = get_colorspace(resolve1(spec))
@@ -368,9 +553,43 @@ class PDFPageInterpreter(object):
     def pop(self, n):
         if n == 0: return []
         x = self.argstack[-n:]
-        self.argstack = self.argstack[:-n]
+        del self.argstack[-n:]
         return x
 
+    # ignore(*args)
+    #   Executed instead of an ignored operator.
+    def ignore(self, *args):
+        return
+
+    # get_operator(kwd)
+    #   Returns the method name and the number of arguments of an operator,
+    #   or None if the operator is not defined. As with hasattr(), a do_*
+    #   attribute set on the instance overrides the method of the class.
+    #   The lookup in the class is cached in the class (and each subclass)
+    #   because it is the same for all the instances.
+    OPERATORS = {}
+    def get_operator(self, kwd):
+        klass = self.__class__
+        try:
+            (method, nargs) = klass.OPERATORS[(klass, kwd)]
+        except KeyError:
+            name = keyword_name(kwd)
+            method = 'do_%s' % name.replace('*','_a').replace('"','_w').replace("'",'_q')
+            nargs = None
+            func = getattr(klass, method, None)
+            if func is not None:
+                nargs = func.func_code.co_argcount-1
+            klass.OPERATORS[(klass, kwd)] = (method, nargs)
+        if method in self.__dict__:
+            func = self.__dict__[method]
+            nargs = func.func_code.co_argcount
+            if getattr(func, 'im_self', None) is not None:
+                # a bound method does not take self.
+                nargs -= 1
+        if nargs is None:
+            return None
+        return (method, nargs)
+
     def get_current_state(self):
         return (self.ctm, self.textstate.copy(), self.graphicstate.copy())
 
@@ -713,13 +932,18 @@ class PDFPageInterpreter(object):
             print >>stderr, 'Processing xobj: %r' % xobj
         subtype = xobj.get('Subtype')
         if subtype is LITERAL_FORM and 'BBox' in xobj:
-            interpreter = self.dup()
             bbox = list_value(xobj['BBox'])
             matrix = list_value(xobj.get('Matrix', MATRIX_IDENTITY))
             self.device.begin_figure(xobjid, bbox, matrix)
-            interpreter.render_contents(dict_value(xobj.get('Resources')), [xobj], ctm=mult_matrix(matrix, self.ctm))
+            if not self.device.reuse_figure(xobj):
+                interpreter = self.dup()
+                interpreter.render_contents(dict_value(xobj.get('Resources')), [xobj],
+                                            ctm=mult_matrix(matrix, self.ctm), reuse=True)
+                # the form may have changed the ctm of the device.
+                self.device.set_ctm(self.ctm)
             self.device.end_figure(xobjid)
         elif subtype is LITERAL_IMAGE and 'Width' in xobj and 'Height' in xobj:
+            if not self.device.want_images: return
             self.device.begin_figure(xobjid, (0,0,1,1), MATRIX_IDENTITY)
             self.device.render_image(xobjid, xobj)
             self.device.end_figure(xobjid)
@@ -728,9 +952,10 @@ class PDFPageInterpreter(object):
             pass
         return
 
-    def process_page(self, page):
-        if 1 <= self.debug:
-            print >>stderr, 'Processing page: %r' % page
+    # get_page_ctm(page)
+    #   Returns the ctm that moves the mediabox of a page
+    #   to the origin and rotates it.
+    def get_page_ctm(self, page):
         (x0,y0,x1,y1) = page.mediabox
         if page.rotate == 90:
             ctm = (0,-1,1,0, -y0,x1)
@@ -740,52 +965,74 @@ class PDFPageInterpreter(object):
             ctm = (0,1,-1,0, y1,-x0)
         else:
             ctm = (1,0,0,1, -x0,-y0)
+        return ctm
+
+    def process_page(self, page):
+        if 1 <= self.debug:
+            print >>stderr, 'Processing page: %r' % page
+        ctm = self.get_page_ctm(page)
+        self.rsrc.set_document(page.doc)
         self.device.begin_page(page, ctm)
         self.render_contents(page.resources, page.contents, ctm=ctm)
-        self.device.end_page(page)
+        return self.device.end_page(page)
+
+    # skip_page(page)
+    #   Lets the device skip a page that is processed elsewhere.
+    def skip_page(self, page):
+        self.device.skip_page(page, self.get_page_ctm(page))
         return
 
-    # render_contents(resources, streams, ctm)
+    # render_contents(resources, streams, ctm, reuse=False)
     #   Render the content streams.
     #   This method may be called recursively.
-    def render_contents(self, resources, streams, ctm=MATRIX_IDENTITY):
+    #   If reuse is True, the stream may be drawn many times
+    #   (a Form XObject) and is compiled by the resource manager.
+    def render_contents(self, resources, streams, ctm=MATRIX_IDENTITY, reuse=False):
         self.init_resources(resources)
         self.init_state(ctm)
-        self.execute(list_value(streams))
+        self.execute(list_value(streams), reuse=reuse)
         return
 
-    def execute(self, streams):
-        try:
-            parser = PDFContentParser(streams)
-        except PSEOF:
-            # empty page
-            return
-        while 1:
+    def execute(self, streams, reuse=False):
+        # A Form XObject that is executed more than once
+        # is replayed from the compiled program.
+        program = None
+        if reuse and len(streams) == 1:
+            strm = resolve1(streams[0])
+            if isinstance(strm, PDFStream) and strm.objid is not None:
+                program = self.rsrc.get_program(strm, images=self.device.want_images)
+        if program is None:
+            program = iter_instructions(streams, images=self.device.want_images)
+        optable = self.optable
+        argstack = self.argstack
+        for (obj, operands) in program:
+            if operands:
+                argstack.extend(operands)
             try:
-                (_,obj) = parser.nextobject()
-            except PSEOF:
-                break
-            if isinstance(obj, PSKeyword):
-                name = keyword_name(obj)
-                method = 'do_%s' % name.replace('*','_a').replace('"','_w').replace("'",'_q')
-                if hasattr(self, method):
-                    func = getattr(self, method)
-                    nargs = func.func_code.co_argcount-1
-                    if nargs:
-                        args = self.pop(nargs)
-                        if 1 <= self.debug:
-                            print >>stderr, 'exec: %s %r' % (name, args)
-                        if len(args) == nargs:
-                            func(*args)
-                    else:
-                        if 1 <= self.debug:
-                            print >>stderr, 'exec: %s' % (name)
-                        func()
-                else:
+                (func, nargs) = optable[obj]
+            except KeyError:
+                op = self.get_operator(obj)
+                if op is None:
                     if STRICT:
-                        raise PDFInterpreterError('Unknown operator: %r' % name)
+                        raise PDFInterpreterError('Unknown operator: %r' % keyword_name(obj))
+                    continue
+                (method, nargs) = op
+                if method in self.ignored:
+                    func = self.ignore
+                else:
+                    func = getattr(self, method)
+                optable[obj] = (func, nargs)
+            if nargs:
+                args = argstack[-nargs:]
+                del argstack[-nargs:]
+                if 1 <= self.debug:
+                    print >>stderr, 'exec: %s %r' % (keyword_name(obj), args)
+                if len(args) == nargs:
+                    func(*args)
             else:
-                self.push(obj)
+                if 1 <= self.debug:
+                    print >>stderr, 'exec: %s' % keyword_name(obj)
+                func()
         return
 
 
@@ -793,17 +1040,47 @@ class PDFPageInterpreter(object):
 ##
 class PDFTextExtractionNotAllowed(PDFInterpreterError): pass
 
-def process_pdf(rsrc, device, fp, pagenos=None, maxpages=0, password=''):
-    doc = PDFDocument()
+# open_document(fp, password='', cachedir=None)
+#   Returns an initialized PDFDocument of a file.
+def open_document(fp, password='', cachedir=None):
+    doc = PDFDocument(cachedir=cachedir)
     parser = PDFParser(fp)
     parser.set_document(doc)
     doc.set_parser(parser)
     doc.initialize(password)
     if not doc.is_extractable:
         raise PDFTextExtractionNotAllowed('Text extraction is not allowed: %r' % fp)
-    interpreter = PDFPageInterpreter(rsrc, device)
+    return doc
+
+# iter_pages(doc, pagenos=None, maxpages=0)
+#   Yields (pageno, page) of the pages to process.
+#   The pages are read lazily from the document.
+def iter_pages(doc, pagenos=None, maxpages=0):
+    if pagenos:
+        # jump to the requested pages directly, unless there are
+        # so many of them that walking the tree once is cheaper.
+        if doc.DIRECT_PAGES < len(pagenos):
+            doc.load_pages()
+        for pageno in sorted(pagenos):
+            try:
+                page = doc.get_page(pageno)
+            except IndexError:
+                # get_page() walks the whole tree when /Count is wrong,
+                # so there is no such page or any page after it.
+                if 1 <= doc.debug:
+                    print >>stderr, 'iter_pages: no page %d' % pageno
+                break
+            yield (pageno, page)
+            if maxpages and maxpages <= pageno+1: break
+        return
     for (pageno,page) in enumerate(doc.get_pages()):
-        if pagenos and (pageno not in pagenos): continue
-        interpreter.process_page(page)
+        yield (pageno, page)
         if maxpages and maxpages <= pageno+1: break
     return
+
+def process_pdf(rsrc, device, fp, pagenos=None, maxpages=0, password='', cachedir=None):
+    doc = open_document(fp, password, cachedir)
+    interpreter = PDFPageInterpreter(rsrc, device)
+    for (_,page) in iter_pages(doc, pagenos, maxpages):
+        interpreter.process_page(page)
+    return
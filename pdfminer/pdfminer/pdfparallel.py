@@ -0,0 +1,479 @@
+#!/usr/bin/env python
+
+""" Processing documents in parallel.
+
+The pages of a document are divided into chunks of consecutive
+pages, which are rendered by a pool of worker processes. Each worker
+opens the document by itself and renders the pages with its own
+resource manager and device, which writes into a buffer.
+The outputs are collected and written in page order.
+
+The main process keeps the device that writes the header and
+footer of the output (e.g. <pages> in XML). The device follows
+the pages with skip_page() so that the states carried over from
+page to page (see PDFDevice.get_state) stay consistent.
+A worker is given the state of the device at the beginning of
+each chunk.
+
+The number of chunks being processed or waiting to be written is
+limited, so the outputs do not pile up in memory when the writer
+is slower than the workers. The address space of each worker can
+also be limited (where the resource module is available).
+A worker that runs out of memory or dies is replaced by a new one.
+
+Many files can also be converted at once (process_pdf_batch),
+one file by each worker. Each input gets its own output file.
+
+"""
+
+import sys
+import os
+import time
+import multiprocessing
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+try:
+    import resource
+except ImportError:
+    resource = None
+from pdftypes import PDFException
+from pdfinterp import PDFResourceManager, PDFPageInterpreter
+from pdfinterp import open_document, iter_pages
+
+
+class PDFWorkerError(PDFException): pass
+class PDFWorkerTimeout(PDFWorkerError): pass
+
+
+##  DeviceFactory
+##
+class DeviceFactory(object):
+
+    """A picklable callable that creates a device for a worker.
+
+    DeviceFactory(klass, **kwargs)(rsrc, outfp) returns
+    klass(rsrc, outfp, **kwargs). klass must be defined at
+    the top level of a module and the arguments must be picklable.
+    """
+
+    def __init__(self, klass, **kwargs):
+        self.klass = klass
+        self.kwargs = kwargs
+        return
+
+    def __repr__(self):
+        return '<DeviceFactory: %s>' % self.klass.__name__
+
+    def __call__(self, rsrc, outfp):
+        return self.klass(rsrc, outfp, **self.kwargs)
+
+
+##  WorkerPool
+##
+
+# _worker_main(conn, func, initializer, initargs, maxtasks, maxmem)
+#   The main loop of a worker process. It receives an argument,
+#   calls func with it and sends back (result, error).
+#   The worker quits after maxtasks tasks or a MemoryError.
+def _worker_main(conn, func, initializer, initargs, maxtasks, maxmem):
+    try:
+        try:
+            if maxmem and resource is not None:
+                # an allocation beyond the limit raises MemoryError.
+                (_, hard) = resource.getrlimit(resource.RLIMIT_AS)
+                resource.setrlimit(resource.RLIMIT_AS, (maxmem, hard))
+            initerror = None
+            if initializer is not None:
+                try:
+                    initializer(*initargs)
+                except Exception, e:
+                    # reported as the result of the first task.
+                    initerror = e
+            ntasks = 0
+            while 1:
+                arg = conn.recv()
+                if initerror is not None:
+                    (result, error) = (None, initerror)
+                else:
+                    try:
+                        (result, error) = (func(arg), None)
+                    except Exception, e:
+                        (result, error) = (None, e)
+                try:
+                    conn.send((result, error))
+                except Exception, e:
+                    # the result cannot be pickled.
+                    conn.send((None, PDFWorkerError('Cannot send the result: %r' % e)))
+                ntasks += 1
+                if (initerror is not None or isinstance(error, MemoryError) or
+                    (maxtasks and maxtasks <= ntasks)):
+                    break
+        except (EOFError, IOError, KeyboardInterrupt):
+            # the main process has gone.
+            pass
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        # never return to the code of the parent process after fork.
+        os._exit(0)
+
+class Worker(object):
+
+    def __init__(self, proc, conn):
+        self.proc = proc
+        self.conn = conn
+        self.ntasks = 0
+        self.job = None
+        self.started = None
+        return
+
+    def __repr__(self):
+        return '<Worker: pid=%r, ntasks=%d>' % (self.proc.pid, self.ntasks)
+
+class WorkerPool(object):
+
+    """A pool of worker processes that call the same function.
+
+    Typical usage:
+      pool = WorkerPool(nworkers, func)
+      try:
+        for (arg, result, error) in pool.imap(args):
+          ...
+      finally:
+        pool.terminate()
+
+    The results are returned in the order of the arguments,
+    or as they are finished (see imap).
+    The exception raised by func in a worker is returned as error.
+    A worker is replaced when it has done maxtasks tasks, when it
+    runs out of memory (maxmem is the maximum address space of
+    a worker in bytes), when it takes more than timeout seconds
+    for a task, or when it dies. In the last two cases, the error
+    is a PDFWorkerTimeout or PDFWorkerError.
+
+    >>> def work(x):
+    ...     if x == 1: os._exit(1)
+    ...     if x == 2: time.sleep(10)
+    ...     if x == 3: raise ValueError(x)
+    ...     if x == 4: return ' '*(256<<20)
+    ...     return x*x
+    >>> pool = WorkerPool(2, work, maxmem=192<<20)
+    >>> try:
+    ...     for (arg, result, error) in pool.imap(range(6), timeout=1):
+    ...         print arg, result, error and error.__class__.__name__
+    ... finally:
+    ...     pool.terminate()
+    0 0 None
+    1 None PDFWorkerError
+    2 None PDFWorkerTimeout
+    3 None ValueError
+    4 None MemoryError
+    5 25 None
+    >>> pool = WorkerPool(1, lambda x: os.getpid(), maxtasks=2)
+    >>> try:
+    ...     pids = [ result for (_, result, _) in pool.imap(range(6)) ]
+    ... finally:
+    ...     pool.terminate()
+    >>> len(set(pids))
+    3
+    >>> pool = WorkerPool(2, lambda x: time.sleep(x) or x)
+    >>> try:
+    ...     print [ arg for (arg, _, _) in pool.imap([0.5, 0, 0, 0], ordered=False) ]
+    ... finally:
+    ...     pool.terminate()
+    [0, 0, 0, 0.5]
+    """
+
+    debug = 0
+
+    # The interval of checking the workers while waiting.
+    POLL_INTERVAL = 0.01
+
+    def __init__(self, nworkers, func, initializer=None, initargs=(),
+                 maxtasks=0, maxmem=0):
+        self.nworkers = nworkers
+        self.func = func
+        self.initializer = initializer
+        self.initargs = initargs
+        self.maxtasks = maxtasks
+        self.maxmem = maxmem
+        self.workers = []
+        return
+
+    def __repr__(self):
+        return '<WorkerPool: %r>' % self.workers
+
+    def spawn(self):
+        (conn, child) = multiprocessing.Pipe()
+        proc = multiprocessing.Process(target=_worker_main,
+                                       args=(child, self.func, self.initializer, self.initargs,
+                                             self.maxtasks, self.maxmem))
+        proc.daemon = True
+        proc.start()
+        child.close()
+        worker = Worker(proc, conn)
+        self.workers.append(worker)
+        return worker
+
+    def retire(self, worker, kill=False):
+        if kill:
+            worker.proc.terminate()
+        worker.conn.close()
+        worker.proc.join()
+        self.workers.remove(worker)
+        return
+
+    def terminate(self):
+        # an idle worker waits for the next argument. it does not see
+        # the end of the pipe, which is shared by the other workers.
+        for worker in self.workers[:]:
+            self.retire(worker, kill=True)
+        return
+
+    # check(worker, timeout)
+    #   Checks a busy worker and returns the finished job, or None.
+    def check(self, worker, timeout):
+        job = worker.job
+        if worker.conn.poll():
+            try:
+                (job[1], job[2]) = worker.conn.recv()
+            except (EOFError, IOError):
+                # the worker may not have been reaped yet.
+                job[2] = PDFWorkerError('Worker died: %r' % worker)
+                worker.job = None
+                self.retire(worker, kill=True)
+                return job
+        elif not worker.proc.is_alive():
+            # the worker may have sent the result just before it exits.
+            if worker.conn.poll(): return None
+            job[2] = PDFWorkerError('Worker died: exitcode=%r' % worker.proc.exitcode)
+        elif timeout and timeout < time.time()-worker.started:
+            job[2] = PDFWorkerTimeout('Timeout: %r' % worker)
+            self.retire(worker, kill=True)
+            return job
+        else:
+            return None
+        worker.job = None
+        if (not worker.proc.is_alive() or isinstance(job[2], MemoryError) or
+            (self.maxtasks and self.maxtasks <= worker.ntasks)):
+            # the worker quits by itself.
+            self.retire(worker)
+        return job
+
+    def imap(self, args, maxpending=None, timeout=None, ordered=True):
+        """Yields (arg, result, error) for each of args.
+
+        The results are yielded in the order of args. At most maxpending arguments are being processed or
+        waiting to be yielded at a time (twice the number of
+        workers by default). If ordered is False, the results are
+        yielded as they are finished, so that a slow task does not
+        hold back the others.
+        """
+        if maxpending is None:
+            maxpending = self.nworkers*2
+        args = iter(args)
+        # jobs: [[arg, result, error, done], ...] in the order of args.
+        jobs = []
+        queue = []
+        while 1:
+            while args is not None and len(jobs) < maxpending:
+                try:
+                    job = [args.next(), None, None, False]
+                except StopIteration:
+                    args = None
+                    break
+                jobs.append(job)
+                queue.append(job)
+            if not jobs: break
+            # give the waiting jobs to idle workers.
+            while queue:
+                idle = [ w for w in self.workers if w.job is None ]
+                if idle:
+                    worker = idle[0]
+                elif len(self.workers) < self.nworkers:
+                    worker = self.spawn()
+                else:
+                    break
+                job = queue.pop(0)
+                worker.job = job
+                worker.ntasks += 1
+                worker.started = time.time()
+                try:
+                    worker.conn.send(job[0])
+                except IOError:
+                    # the worker has died. (see check)
+                    pass
+            finished = []
+            for worker in [ w for w in self.workers if w.job is not None ]:
+                job = self.check(worker, timeout)
+                if job is not None:
+                    job[3] = True
+                    finished.append(job)
+                    if self.debug:
+                        print >>sys.stderr, 'done: %r, error=%r' % (job[0], job[2])
+            if not ordered and finished:
+                for job in finished:
+                    jobs.remove(job)
+                    (arg, result, error, _) = job
+                    yield (arg, result, error)
+            elif jobs[0][3]:
+                while jobs and jobs[0][3]:
+                    (arg, result, error, _) = jobs.pop(0)
+                    yield (arg, result, error)
+            else:
+                # wait for the oldest job (or any job if not ordered).
+                for worker in self.workers:
+                    if worker.job is jobs[0] or (not ordered and worker.job is not None):
+                        worker.conn.poll(self.POLL_INTERVAL)
+                        break
+        return
+
+
+##  Rendering pages in parallel
+##
+
+# The document, interpreter, device and buffer of a worker.
+_renderer = None
+
+def _init_renderer(factory, fname, password, cachedir):
+    global _renderer
+    doc = open_document(file(fname, 'rb'), password, cachedir)
+    # the pages are looked up by number for every chunk, so the page
+    # tree is walked once here instead of descended for each page.
+    doc.load_pages()
+    rsrc = PDFResourceManager()
+    outfp = StringIO()
+    device = factory(rsrc, outfp)
+    _renderer = (doc, PDFPageInterpreter(rsrc, device), device, outfp)
+    return
+
+def _render_pages((state, pagenos)):
+    (doc, interpreter, device, outfp) = _renderer
+    device.set_state(state)
+    outputs = []
+    for pageno in pagenos:
+        outfp.seek(0)
+        outfp.truncate()
+        interpreter.process_page(doc.get_page(pageno))
+        outputs.append(outfp.getvalue())
+    return outputs
+
+def process_pdf_parallel(rsrc, device, factory, fname, outfp,
+                         pagenos=None, maxpages=0, password='', cachedir=None,
+                         nworkers=None, chunksize=4, maxpending=None, maxmem=0):
+    """Renders the pages of a file with worker processes.
+
+    device is the device of the main process and factory(rsrc, outfp)
+    creates the same kind of device in each worker (see DeviceFactory).
+    The outputs of the pages are written to outfp in page order.
+    nworkers is the number of workers (the number of CPUs by default)
+    and chunksize is the number of pages given to a worker at once.
+    For maxpending and maxmem, see WorkerPool.
+    """
+    if nworkers is None:
+        nworkers = multiprocessing.cpu_count()
+    fp = file(fname, 'rb')
+    try:
+        doc = open_document(fp, password, cachedir)
+        interpreter = PDFPageInterpreter(rsrc, device)
+        def iter_chunks():
+            (state, chunk) = (None, [])
+            for (pageno, page) in iter_pages(doc, pagenos, maxpages):
+                if not chunk:
+                    state = device.get_state()
+                chunk.append(pageno)
+                interpreter.skip_page(page)
+                if chunksize <= len(chunk):
+                    yield (state, chunk)
+                    chunk = []
+            if chunk:
+                yield (state, chunk)
+            return
+        pool = WorkerPool(nworkers, _render_pages, _init_renderer,
+                          (factory, fname, password, cachedir), maxmem=maxmem)
+        try:
+            for (_, outputs, error) in pool.imap(iter_chunks(), maxpending=maxpending):
+                if error is not None:
+                    raise error
+                outfp.write(''.join(outputs))
+        finally:
+            pool.terminate()
+    finally:
+        fp.close()
+    return
+
+
+##  Converting files in parallel
+##
+
+# _convert_file((factory, fname, outpath, pagenos, maxpages, password, cachedir))
+#   Converts a file into outpath. Returns (npages, elapsed, error)
+#   where error is a message or None. A MemoryError is passed to
+#   the pool so that the worker is replaced.
+def _convert_file((factory, fname, outpath, pagenos, maxpages, password, cachedir)):
+    t0 = time.time()
+    npages = 0
+    error = None
+    try:
+        fp = file(fname, 'rb')
+        try:
+            outfp = file(outpath, 'wb')
+            try:
+                doc = open_document(fp, password, cachedir)
+                rsrc = PDFResourceManager()
+                device = factory(rsrc, outfp)
+                interpreter = PDFPageInterpreter(rsrc, device)
+                for (_, page) in iter_pages(doc, pagenos, maxpages):
+                    interpreter.process_page(page)
+                    npages += 1
+                device.close()
+            finally:
+                outfp.close()
+        finally:
+            fp.close()
+    except MemoryError:
+        raise
+    except Exception, e:
+        error = '%s: %s' % (e.__class__.__name__, e)
+    return (npages, time.time()-t0, error)
+
+def process_pdf_batch(factory, files, pagenos=None, maxpages=0, password='', cachedir=None,
+                      nworkers=None, timeout=600, maxtasks=0, maxmem=0):
+    """Converts files with worker processes, one output file for each.
+
+    files is an iterable of (input path, output path). Each output is
+    written by a device created by factory(rsrc, outfp) and closed.
+    Yields (fname, outpath, npages, elapsed, error) as each file is
+    finished (not in the order of files), where error is None if
+    succeeded, or a message otherwise. The output of a failed file
+    is removed. A file that takes more than timeout seconds (600 by
+    default, 0 or None for no limit) is given up, so that a hung file
+    does not keep a worker forever. A worker is replaced after
+    maxtasks files so that its memory is returned to the system.
+    elapsed is None if the worker was killed or died.
+    """
+    if nworkers is None:
+        nworkers = multiprocessing.cpu_count()
+    args = ( (factory, fname, outpath, pagenos, maxpages, password, cachedir)
+             for (fname, outpath) in files )
+    pool = WorkerPool(nworkers, _convert_file, maxtasks=maxtasks, maxmem=maxmem)
+    try:
+        for (arg, result, error) in pool.imap(args, timeout=timeout, ordered=False):
+            (_, fname, outpath) = arg[:3]
+            if error is not None:
+                (npages, elapsed, error) = (0, None, '%s: %s' % (error.__class__.__name__, error))
+            else:
+                (npages, elapsed, error) = result
+            if error is not None and os.path.exists(outpath):
+                os.remove(outpath)
+            yield (fname, outpath, npages, elapsed, error)
+    finally:
+        pool.terminate()
+    return
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -2,27 +2,33 @@
 import sys
 import re
 import struct
+import mmap
 from sys import stderr
+from array import array
+from bisect import bisect_right
 try:
     import hashlib as md5
 except ImportError:
     import md5
 try:
-    from cStringIO import StringIO
+    from hashlib import sha256, sha384, sha512
 except ImportError:
-    from StringIO import StringIO
+    sha256 = sha384 = sha512 = None
 from psparser import PSStackParser
-from psparser import PSSyntaxError, PSEOF
+from psparser import PSException, PSSyntaxError, PSEOF
 from psparser import literal_name
 from psparser import LIT, KWD, STRICT
 from pdftypes import PDFException, PDFTypeError, PDFNotImplementedError
-from pdftypes import PDFStream, PDFObjRef
-from pdftypes import resolve1, decipher_all
+from pdftypes import PDFStream, PDFStreamCache, PDFObjRef
+from pdftypes import resolve1, decipher_all, estimate_size
 from pdftypes import int_value, float_value, num_value
 from pdftypes import str_value, list_value, dict_value, stream_value
 from arcfour import Arcfour
+from rijndael import RijndaelEncryptor, RijndaelDecryptor
+from pdfcache import PDFIndexCache, PDFCacheError
+from pdfcache import encode_obj, decode_obj
 from utils import choplist, nunpack
-from utils import decode_text, ObjIdRange
+from utils import decode_text, ObjIdRange, LRUCache
 
 
 ##  Exceptions
@@ -37,6 +43,7 @@ LITERAL_OBJSTM = LIT('ObjStm')
 LITERAL_XREF = LIT('XRef')
 LITERAL_PAGE = LIT('Page')
 LITERAL_PAGES = LIT('Pages')
+LITERAL_METADATA = LIT('Metadata')
 LITERAL_CATALOG = LIT('Catalog')
 
 
@@ -53,6 +60,16 @@ class PDFBaseXRef(object):
     def get_pos(self, objid):
         raise KeyError(objid)
 
+    def get_entries(self):
+        '''Yields (objid, strmid, pos) for every object in use.'''
+        for objid in self.get_objids():
+            try:
+                (strmid, pos) = self.get_pos(objid)
+            except KeyError:
+                continue
+            yield (objid, strmid, pos)
+        return
+
 
 ##  PDFXRef
 ##
@@ -82,22 +99,46 @@ class PDFXRef(PDFBaseXRef):
                 (start, nobjs) = map(long, f)
             except ValueError:
                 raise PDFNoValidXRef('Invalid line: %r: line=%r' % (parser, line))
-            for objid in xrange(start, start+nobjs):
-                try:
-                    (_, line) = parser.nextline()
-                except PSEOF:
-                    raise PDFNoValidXRef('Unexpected EOF - file corrupted?')
-                f = line.strip().split(' ')
-                if len(f) != 3:
-                    raise PDFNoValidXRef('Invalid XRef format: %r, line=%r' % (parser, line))
-                (pos, genno, use) = f
-                if use != 'n': continue
-                self.offsets[objid] = (int(genno), long(pos))
+            if not self.load_subsection(parser, start, nobjs):
+                self.load_subsection_lines(parser, start, nobjs)
         if debug:
             print >>stderr, 'xref objects:', self.offsets
         self.load_trailer(parser)
         return
 
+    # Every entry of a well-formed xref table is exactly 20 bytes long.
+    XREF_ENTRIES = re.compile(r'(?:\d{10} \d{5} [fn](?: \r| \n|\r\n))*')
+    XREF_ENTRY_USED = re.compile(r'(\d{10}) (\d{5}) n')
+    def load_subsection(self, parser, start, nobjs):
+        """Reads a whole subsection at once.
+
+        Returns False if any entry does not have the standard
+        fixed width, leaving the parser position intact.
+        """
+        pos = parser.tell()
+        data = parser.fetch(pos, nobjs*20)
+        m = self.XREF_ENTRIES.match(data)
+        if m.end(0) != nobjs*20: return False
+        self.offsets.update( (start+m.start(0)/20, (int(m.group(2)), long(m.group(1))))
+                             for m in self.XREF_ENTRY_USED.finditer(data) )
+        parser.seek(pos+nobjs*20)
+        return True
+
+    def load_subsection_lines(self, parser, start, nobjs):
+        """Reads a subsection line by line, tolerating malformed entries."""
+        for objid in xrange(start, start+nobjs):
+            try:
+                (_, line) = parser.nextline()
+            except PSEOF:
+                raise PDFNoValidXRef('Unexpected EOF - file corrupted?')
+            f = line.strip().split(' ')
+            if len(f) != 3:
+                raise PDFNoValidXRef('Invalid XRef format: %r, line=%r' % (parser, line))
+            (pos, genno, use) = f
+            if use != 'n': continue
+            self.offsets[objid] = (int(genno), long(pos))
+        return
+
     KEYWORD_TRAILER = KWD('trailer')
     def load_trailer(self, parser):
         try:
@@ -112,26 +153,6 @@ class PDFXRef(PDFBaseXRef):
         self.trailer.update(dict_value(dic))
         return
 
-    PDFOBJ_CUE = re.compile(r'^(\d+)\s+(\d+)\s+obj\b')
-    def load_fallback(self, parser, debug=0):
-        parser.seek(0)
-        while 1:
-            try:
-                (pos, line) = parser.nextline()
-            except PSEOF:
-                break
-            if line.startswith('trailer'):
-                parser.seek(pos)
-                self.load_trailer(parser)
-                if 1 <= debug:
-                    print >>stderr, 'trailer: %r' % self.get_trailer()
-                break
-            m = self.PDFOBJ_CUE.match(line)
-            if not m: continue
-            (objid, genno) = m.groups()
-            self.offsets[int(objid)] = (0, pos)
-        return
-
     def get_trailer(self):
         return self.trailer
 
@@ -145,6 +166,215 @@ class PDFXRef(PDFBaseXRef):
             raise
         return (None, pos)
 
+    def get_entries(self):
+        for (objid, (genno, pos)) in self.offsets.iteritems():
+            yield (objid, None, pos)
+        return
+
+
+##  PDFXRefFallback
+##
+class PDFXRefFallback(PDFXRef):
+
+    """An XRef table reconstructed by scanning a damaged file.
+
+    The whole file is scanned for every "objid genno obj" marker,
+    "trailer" keyword and /Type of object streams, XRef streams and
+    catalogs. Each kind of cue has its own regular expression that
+    begins with a literal, which the regexp engine searches much
+    faster than an alternation. When an object is defined more than
+    once, the last definition in the file wins. The objects contained
+    in object streams are also indexed (unless the file is encrypted),
+    and all the trailers and XRef stream dictionaries are merged in
+    the order of appearance. An indirect /Length of these streams is
+    resolved with the scanned offsets, as the document cannot resolve
+    any reference until the table is built.
+
+    The reconstructed table can be kept for later use with
+    the index cache of PDFDocument.
+    """
+
+    OBJ_CUE = re.compile(r'obj\b')
+    # "objid genno " before an OBJ_CUE, matched backwards.
+    OBJ_CUE_REV = re.compile(r'[\r\n\t\f \x00]+(\d+)[\r\n\t\f \x00]+(\d+)(?![^\r\n\t\f \x00])')
+    TRAILER_CUE = re.compile(r'trailer\b')
+    TYPE_CUE = re.compile(r'/Type\s*/(ObjStm|XRef|Catalog)\b')
+    WHITESPACE = '\r\n\t\f \x00'
+    # keys of an XRef stream dictionary that are also used in a trailer.
+    TRAILER_KEYS = ('Size', 'Root', 'Encrypt', 'Info', 'ID')
+    # "objid genno obj integer" of an indirect /Length.
+    INT_OBJ = re.compile(r'\s*(\d+)\s+\d+\s+obj\s*(\d+)(?![.\d])')
+
+    def __init__(self):
+        PDFXRef.__init__(self)
+        # objid -> (strmid, index) for objects in object streams.
+        self.strmobjs = {}
+        return
+
+    def __repr__(self):
+        return '<PDFXRefFallback: objs=%d, strmobjs=%d>' % (len(self.offsets), len(self.strmobjs))
+
+    def load(self, parser, debug=0):
+        data = self.get_buffer(parser)
+        try:
+            objs = []
+            for m in self.OBJ_CUE.finditer(data):
+                i = m.start(0)
+                if i == 0 or data[i-1] not in self.WHITESPACE: continue
+                m = self.OBJ_CUE_REV.match(data[max(0, i-40):i][::-1])
+                if not m: continue
+                pos = i-m.end(0)
+                objid = int(m.group(2)[::-1])
+                objs.append((pos, objid))
+                self.offsets[objid] = (int(m.group(1)[::-1]), pos)
+            trailers = [ m.start(0) for m in self.TRAILER_CUE.finditer(data) ]
+            typed = { 'ObjStm': [], 'XRef': [], 'Catalog': [] }
+            objposs = [ pos for (pos,_) in objs ]
+            for m in self.TYPE_CUE.finditer(data):
+                # the type is attributed to the last object before it.
+                i = bisect_right(objposs, m.start(0))
+                if i:
+                    (pos, objid) = objs[i-1]
+                    typed[m.group(1)].append((objid, pos))
+        finally:
+            if isinstance(data, mmap.mmap) and data is not parser.data:
+                data.close()
+        if 1 <= debug:
+            print >>stderr, ('fallback: objs=%d, trailers=%d, objstms=%d, xrefstms=%d' %
+                             (len(self.offsets), len(trailers),
+                              len(typed['ObjStm']), len(typed['XRef'])))
+        parser.fallback = self
+        try:
+            self.load_streams(parser, trailers, typed)
+        finally:
+            parser.fallback = None
+        if 1 <= debug:
+            print >>stderr, 'trailer: %r' % self.trailer
+        return
+
+    def load_streams(self, parser, trailers, typed):
+        # merge the trailers and XRef stream dictionaries.
+        dics = []
+        for pos in trailers:
+            dic = self.read_trailer_at(parser, pos)
+            if dic is not None:
+                dics.append((pos, dic))
+        for (objid, pos) in typed['XRef']:
+            stream = self.read_stream_at(parser, objid, pos)
+            if stream is not None and stream.get('Type') is LITERAL_XREF:
+                dics.append((pos, dict( (k, stream[k]) for k in self.TRAILER_KEYS if k in stream )))
+        dics.sort(key=lambda (pos,dic): pos)
+        for (_,dic) in dics:
+            self.trailer.update(dic)
+        self.trailer.pop('Prev', None)
+        self.trailer.pop('XRefStm', None)
+        if 'Root' not in self.trailer:
+            for (objid, pos) in reversed(typed['Catalog']):
+                if self.offsets.get(objid, (0,pos))[1] == pos:
+                    self.trailer['Root'] = PDFObjRef(parser.doc, objid, 0)
+                    break
+        # index the objects in object streams.
+        # The data cannot be read before the document is decrypted.
+        if 'Encrypt' not in self.trailer:
+            defpos = {}
+            for (strmid, pos) in typed['ObjStm']:
+                if self.offsets.get(strmid, (0,None))[1] != pos: continue
+                stream = self.read_stream_at(parser, strmid, pos)
+                if stream is None or stream.get('Type') is not LITERAL_OBJSTM: continue
+                for (index, objid) in enumerate(self.read_objstm_objids(stream)):
+                    if objid in self.offsets and pos < self.offsets[objid][1]: continue
+                    if objid in defpos and pos < defpos[objid]: continue
+                    self.offsets.pop(objid, None)
+                    self.strmobjs[objid] = (strmid, index)
+                    defpos[objid] = pos
+        return
+
+    def get_buffer(self, parser):
+        """Returns the entire file as a string or an mmap object."""
+        if parser.data is not None:
+            return parser.data
+        try:
+            return mmap.mmap(parser.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, EnvironmentError, ValueError):
+            pass
+        pos0 = parser.fp.tell()
+        parser.fp.seek(0)
+        data = parser.fp.read()
+        parser.fp.seek(pos0)
+        return data
+
+    KEYWORD_OBJ = KWD('obj')
+    def read_stream_at(self, parser, objid, pos):
+        parser.seek(pos)
+        try:
+            (_,objid1) = parser.nexttoken()
+            (_,genno) = parser.nexttoken()
+            (_,kwd) = parser.nexttoken()
+            if objid1 != objid or kwd is not self.KEYWORD_OBJ:
+                return None
+            (_,obj) = parser.nextobject()
+        except (PSException, ValueError, TypeError, KeyError):
+            return None
+        if not isinstance(obj, PDFStream): return None
+        obj.set_objid(objid, genno)
+        return obj
+
+    def read_int_at(self, parser, objid):
+        """Returns the integer defined as objid, or None."""
+        try:
+            (_, pos) = self.offsets[objid]
+        except KeyError:
+            return None
+        m = self.INT_OBJ.match(parser.fetch(pos, 64))
+        if not m or int(m.group(1)) != objid:
+            return None
+        return int(m.group(2))
+
+    def read_trailer_at(self, parser, pos):
+        parser.seek(pos)
+        try:
+            (_,kwd) = parser.nexttoken()
+            (_,dic) = parser.nextobject()
+        except (PSException, ValueError, TypeError, KeyError):
+            return None
+        if not isinstance(dic, dict): return None
+        return dic
+
+    def read_objstm_objids(self, stream):
+        objids = []
+        try:
+            n = int_value(stream.get('N', 0))
+            parser = PDFStreamParser(stream.get_data())
+            for _ in xrange(n):
+                (_,objid) = parser.nexttoken()
+                (_,offset) = parser.nexttoken()
+                if not isinstance(objid, int): break
+                objids.append(objid)
+        except Exception:
+            # a damaged stream can fail to decode in many ways;
+            # keep the objids read so far.
+            pass
+        return objids
+
+    def get_objids(self):
+        for objid in self.offsets.iterkeys():
+            yield objid
+        for objid in self.strmobjs.iterkeys():
+            yield objid
+        return
+
+    def get_pos(self, objid):
+        if objid in self.strmobjs:
+            return self.strmobjs[objid]
+        return PDFXRef.get_pos(self, objid)
+
+    def get_entries(self):
+        for (objid, (genno, pos)) in self.offsets.iteritems():
+            yield (objid, None, pos)
+        for (objid, (strmid, index)) in self.strmobjs.iteritems():
+            yield (objid, strmid, index)
+        return
+
 
 ##  PDFXRefStream
 ##
@@ -217,6 +447,150 @@ class PDFXRefStream(PDFBaseXRef):
         # this is a free object
         raise KeyError(objid)
 
+    def get_entries(self):
+        (fl1, fl2, entlen) = (self.fl1, self.fl1+self.fl2, self.entlen)
+        i = 0
+        for objid_range in self.objid_ranges:
+            for objid in xrange(objid_range.get_start_id(), objid_range.get_end_id()+1):
+                ent = self.data[i:i+entlen]
+                i += entlen
+                f1 = nunpack(ent[:fl1], 1)
+                if f1 == 1:
+                    yield (objid, None, nunpack(ent[fl1:fl2]))
+                elif f1 == 2:
+                    yield (objid, nunpack(ent[fl1:fl2]), nunpack(ent[fl2:]))
+        return
+
+
+##  PDFXRefIndex
+##
+class PDFXRefIndex(object):
+
+    """A lookup table merged from all the XRef sections of a file.
+
+    The position of each object is kept in parallel arrays indexed
+    by objid, so a lookup costs the same regardless of how many
+    sections (incremental updates) the file has. When an object
+    appears in more than one section, the newest one wins.
+    Free entries do not hide the older definitions.
+
+    Very large objids that would make the arrays sparse are
+    kept in a dictionary instead.
+    """
+
+    # kinds of entries.
+    FREE = 0
+    OFFSET = 1    # (offset in the file)
+    STREAM = 2    # (objid of the object stream, index in it)
+
+    def __init__(self, xrefs=()):
+        """xrefs: a list of XRef sections, the newest first."""
+        self.kinds = array('B')
+        self.strmids = array('L')
+        self.positions = array('L')
+        self.sparse = {}
+        for xref in reversed(xrefs):
+            for (objid, strmid, pos) in xref.get_entries():
+                self.add(objid, strmid, pos)
+        return
+
+    def dump(self):
+        """Returns the contents of the index as marshallable values."""
+        return (self.kinds.tostring(), self.strmids.tostring(),
+                self.positions.tostring(), self.sparse)
+
+    def load(self, state):
+        """Restores the contents saved by dump()."""
+        (kinds, strmids, positions, sparse) = state
+        self.kinds = array('B', kinds)
+        self.strmids = array('L', strmids)
+        self.positions = array('L', positions)
+        if not (len(self.kinds) == len(self.strmids) == len(self.positions)):
+            raise ValueError('Inconsistent index')
+        self.sparse = dict(sparse)
+        return
+
+    def __repr__(self):
+        return '<PDFXRefIndex: objs=%d>' % len(self)
+
+    def __len__(self):
+        n = len(self.kinds)
+        return (n-self.kinds.count(self.FREE)+
+                sum( 1 for objid in self.sparse if n <= objid or self.kinds[objid] == self.FREE ))
+
+    def grow(self, size):
+        n = size-len(self.kinds)
+        self.kinds.extend(array('B', [self.FREE])*n)
+        self.strmids.extend(array('L', [0])*n)
+        self.positions.extend(array('L', [0])*n)
+        return
+
+    def add(self, objid, strmid, pos):
+        if objid < 0 or pos < 0: return
+        n = len(self.kinds)
+        if n <= objid:
+            if max(2*n, 65536) <= objid:
+                self.sparse[objid] = (strmid, pos)
+                return
+            self.grow(max(2*n, objid+1))
+        if strmid is None:
+            self.kinds[objid] = self.OFFSET
+            self.strmids[objid] = 0
+        else:
+            self.kinds[objid] = self.STREAM
+            self.strmids[objid] = strmid
+        self.positions[objid] = pos
+        return
+
+    def get_objids(self):
+        for (objid, kind) in enumerate(self.kinds):
+            if kind != self.FREE:
+                yield objid
+        for objid in sorted(self.sparse):
+            if len(self.kinds) <= objid or self.kinds[objid] == self.FREE:
+                yield objid
+        return
+
+    def get_pos(self, objid):
+        if 0 <= objid < len(self.kinds):
+            kind = self.kinds[objid]
+            if kind == self.OFFSET:
+                return (None, self.positions[objid])
+            elif kind == self.STREAM:
+                return (self.strmids[objid], self.positions[objid])
+        return self.sparse[objid]
+
+
+##  PDFCachedXRef
+##
+class PDFCachedXRef(PDFBaseXRef):
+
+    """An XRef section restored from an index cache.
+
+    Only the trailer of each section is kept. The objects of
+    the whole document are listed by the first section, which
+    holds the merged index.
+    """
+
+    def __init__(self, trailer, index=None):
+        self.trailer = trailer
+        self.index = index
+        return
+
+    def __repr__(self):
+        return '<PDFCachedXRef: index=%r>' % self.index
+
+    def get_trailer(self):
+        return self.trailer
+
+    def get_objids(self):
+        if self.index is None: return []
+        return self.index.get_objids()
+
+    def get_pos(self, objid):
+        if self.index is None: raise KeyError(objid)
+        return self.index.get_pos(objid)
+
 
 ##  PDFPage
 ##
@@ -275,6 +649,46 @@ class PDFPage(object):
         return '<PDFPage: Resources=%r, MediaBox=%r>' % (self.resources, self.mediabox)
 
 
+##  Standard security handler
+##
+
+# hash_rev5(password, salt, udata='')
+#   Algorithm 3.2a: a single SHA-256 hash (revision 5).
+def hash_rev5(password, salt, udata=''):
+    return sha256(password+salt+udata).digest()
+
+# hash_rev6(password, salt, udata='')
+#   Algorithm 2.B of PDF 2.0 (revision 6).
+def hash_rev6(password, salt, udata=''):
+    k = sha256(password+salt+udata).digest()
+    i = 0
+    while 1:
+        k1 = (password+k+udata)*64
+        e = RijndaelEncryptor(k[:16], 128).encrypt_cbc(k[16:32], k1)
+        # The first 16 bytes of E as a big-endian number modulo 3
+        # equals the sum of the bytes modulo 3.
+        n = sum(ord(c) for c in e[:16]) % 3
+        k = (sha256, sha384, sha512)[n](e).digest()
+        i += 1
+        if 64 <= i and ord(e[-1]) <= i-32: break
+    return k[:32]
+
+# aes_cbc_decrypt(aes, data)
+#   Decrypts the data of a string or stream encrypted with AES.
+#   The data begins with a 16-byte initialization vector
+#   and is padded as described in PKCS#5.
+def aes_cbc_decrypt(aes, data):
+    (iv, data) = (data[:16], data[16:])
+    # Ignore an incomplete block at the end.
+    data = data[:len(data) - len(data) % 16]
+    if not data: return ''
+    data = aes.decrypt_cbc(iv, data)
+    n = ord(data[-1])
+    if 1 <= n <= 16:
+        data = data[:-n]
+    return data
+
+
 ##  PDFDocument
 ##
 class PDFDocument(object):
@@ -290,19 +704,62 @@ class PDFDocument(object):
       doc.set_parser(parser)
       doc.initialize(password)
       obj = doc.getobj(objid)
-    
+
+    If cachedir is given, the XRefs and the page list are stored
+    in that directory and reused when the same file is opened again.
+
+    Parsed objects are kept in objcache, an LRUCache bounded by
+    OBJCACHE_MAXBYTES by default. Any object that has the same
+    interface (item access and pin()) can be given instead.
+    The catalog and the page tree nodes are pinned in the cache.
+
+    The decoded data of streams is kept in datacache,
+    a PDFStreamCache bounded by DATACACHE_MAXBYTES by default.
+
+    The key schedules of encrypted objects are kept in LRUCaches
+    bounded by CRYPTCACHE_MAXENTRIES.
+
+    The decoded data of the last object stream read is kept
+    regardless of its size, so that the objects in the same
+    object stream are read without decoding the stream again.
+
+    get_page() descends the page tree for the first DIRECT_PAGES
+    pages requested. After that, or when the tree turns out to be
+    broken, the whole tree is walked once and the pages are kept.
     """
 
     debug = 0
 
-    def __init__(self):
+    OBJCACHE_MAXBYTES = 32*1024*1024
+    DATACACHE_MAXBYTES = 32*1024*1024
+    CRYPTCACHE_MAXENTRIES = 256
+    DIRECT_PAGES = 4
+
+    def __init__(self, cachedir=None, objcache=None, datacache=None):
         self.xrefs = []
-        self.objs = {}
-        self.parsed_objs = {}
+        self.xrefindex = None
+        self.indexcache = None
+        if cachedir:
+            self.indexcache = PDFIndexCache(cachedir)
+        self.cachedpages = None
+        # pagelist: [(objid, tree), ...] of all the pages (see load_pages).
+        self.pagelist = None
+        self.ndirect = 0
+        if objcache is None:
+            objcache = LRUCache(maxbytes=self.OBJCACHE_MAXBYTES, sizefunc=estimate_size)
+        self.objcache = objcache
+        if datacache is None:
+            datacache = PDFStreamCache(self.DATACACHE_MAXBYTES)
+        self.datacache = datacache
         self.info = []
         self.catalog = None
         self.encryption = None
         self.decipher = None
+        self.stream_decipher = None
+        self.encrypt_metadata = True
+        self.rc4cache = LRUCache(maxentries=self.CRYPTCACHE_MAXENTRIES)
+        self.aescache = LRUCache(maxentries=self.CRYPTCACHE_MAXENTRIES)
+        self._objstm = None
         self._parser = None
         return
 
@@ -310,9 +767,12 @@ class PDFDocument(object):
         "Set the document to use a given PDFParser object."
         if self._parser: return
         self._parser = parser
-        # Retrieve the information of each header that was appended
-        # (maybe multiple times) at the end of the document.
-        self.xrefs = parser.read_xref()
+        if not self.load_index():
+            # Retrieve the information of each header that was appended
+            # (maybe multiple times) at the end of the document.
+            self.xrefs = parser.read_xref()
+            self.xrefindex = PDFXRefIndex(self.xrefs)
+            self.save_index()
         for xref in self.xrefs:
             trailer = xref.get_trailer()
             if not trailer: continue
@@ -325,6 +785,8 @@ class PDFDocument(object):
                 self.info.append(dict_value(trailer['Info']))
             if 'Root' in trailer:
                 #  Every PDF file must have exactly one /Root dictionary.
+                if isinstance(trailer['Root'], PDFObjRef):
+                    self.objcache.pin(trailer['Root'].objid)
                 self.catalog = dict_value(trailer['Root'])
                 break
         else:
@@ -334,6 +796,44 @@ class PDFDocument(object):
                 raise PDFSyntaxError('Catalog not found!')
         return
 
+    def load_index(self):
+        "Restore the XRefs and the page list from the index cache."
+        if not self.indexcache: return False
+        entry = self.indexcache.load(self._parser)
+        if entry is None: return False
+        try:
+            index = PDFXRefIndex()
+            index.load(entry['xrefindex'])
+            xrefs = []
+            for trailer in entry['trailers']:
+                xrefs.append(PDFCachedXRef(decode_obj(self, trailer)))
+            xrefs[0].index = index
+            pages = entry.get('pages')
+        except (KeyError, IndexError, TypeError, ValueError, PDFCacheError), e:
+            if self.debug:
+                print >>stderr, 'load_index: invalid entry: %s' % e
+            return False
+        self.xrefs = xrefs
+        self.xrefindex = index
+        self.cachedpages = pages
+        return True
+
+    def save_index(self):
+        "Store the XRefs and the page list (if known) in the index cache."
+        if not self.indexcache: return False
+        try:
+            entry = {
+                'xrefindex': self.xrefindex.dump(),
+                'trailers': [ encode_obj(xref.get_trailer()) for xref in self.xrefs ],
+                }
+        except PDFCacheError, e:
+            if self.debug:
+                print >>stderr, 'save_index: %s' % e
+            return False
+        if self.cachedpages is not None:
+            entry['pages'] = self.cachedpages
+        return self.indexcache.save(self._parser, entry)
+
     # initialize(password='')
     #   Perform the initialization with a given password.
     #   This step is mandatory even if there's no password associated
@@ -347,27 +847,66 @@ class PDFDocument(object):
         if literal_name(param.get('Filter')) != 'Standard':
             raise PDFEncryptionError('Unknown filter: param=%r' % param)
         V = int_value(param.get('V', 0))
-        if not (V == 1 or V == 2):
+        if V not in (1, 2, 4, 5):
             raise PDFEncryptionError('Unknown algorithm: param=%r' % param)
-        length = int_value(param.get('Length', 40)) # Key length (bits)
-        O = str_value(param['O'])
         R = int_value(param['R']) # Revision
-        if 5 <= R:
+        if V == 5:
+            if R not in (5, 6):
+                raise PDFEncryptionError('Unknown revision: %r' % R)
+        elif R not in (2, 3, 4):
             raise PDFEncryptionError('Unknown revision: %r' % R)
-        U = str_value(param['U'])
         P = int_value(param['P'])
         self.is_printable = bool(P & 4)
         self.is_modifiable = bool(P & 8)
         self.is_extractable = bool(P & 16)
+        self.encrypt_metadata = bool(param.get('EncryptMetadata', True))
+        if V == 5:
+            key = self.authenticate_sha256(password, param, R)
+        else:
+            if V == 4:
+                length = int_value(param.get('Length', 128)) # Key length (bits)
+            else:
+                length = int_value(param.get('Length', 40)) # Key length (bits)
+            key = self.authenticate_md5(password, docid, param, R, length)
+        if key is None:
+            raise PDFPasswordIncorrect
+        self.decrypt_key = key
+        if V < 4:
+            self.decipher = self.stream_decipher = self.decrypt_rc4
+        else:
+            # Strings and streams can use different crypt filters.
+            self.decipher = self.get_crypt_filter(param, param.get('StrF'))
+            self.stream_decipher = self.get_crypt_filter(param, param.get('StmF'))
+        # Objects are deciphered when they are read from the file, but
+        # the catalog and the document info have been read already.
+        # Discard them and read them again.
+        self.objcache.clear()
+        self.datacache.clear()
+        self.info = []
+        for xref in self.xrefs:
+            trailer = xref.get_trailer()
+            if not trailer: continue
+            if 'Info' in trailer:
+                self.info.append(dict_value(trailer['Info']))
+            if 'Root' in trailer:
+                self.catalog = dict_value(trailer['Root'])
+                break
+        return
+
+    def authenticate_md5(self, password, docid, param, R, length):
+        '''Computes the encryption key of revision 2-4 from the user password.
+        Returns None if the password is incorrect.'''
+        O = str_value(param['O'])
+        U = str_value(param['U'])
+        P = int_value(param['P'])
         # Algorithm 3.2
         password = (password+self.PASSWORD_PADDING)[:32] # 1
         hash = md5.md5(password) # 2
         hash.update(O) # 3
         hash.update(struct.pack('<l', P)) # 4
         hash.update(docid[0]) # 5
-        if 4 <= R:
-            # 6
-            raise PDFNotImplementedError('Revision 4 encryption is currently unsupported')
+        if 4 <= R and not self.encrypt_metadata:
+            hash.update('\xff\xff\xff\xff') # 6
         if 3 <= R:
             # 8
             for _ in xrange(50):
@@ -376,7 +915,8 @@ class PDFDocument(object):
         if R == 2:
             # Algorithm 3.4
             u1 = Arcfour(key).process(self.PASSWORD_PADDING)
-        elif R == 3:
+            is_authenticated = (u1 == U)
+        else:
             # Algorithm 3.5
             hash = md5.md5(self.PASSWORD_PADDING) # 2
             hash.update(docid[0]) # 3
@@ -384,22 +924,85 @@ class PDFDocument(object):
             for i in xrange(1,19+1):
                 k = ''.join( chr(ord(c) ^ i) for c in key )
                 x = Arcfour(k).process(x)
-            u1 = x+x # 32bytes total
-        if R == 2:
-            is_authenticated = (u1 == U)
-        else:
-            is_authenticated = (u1[:16] == U[:16])
+            is_authenticated = (x == U[:16])
         if not is_authenticated:
-            raise PDFPasswordIncorrect
-        self.decrypt_key = key
-        self.decipher = self.decrypt_rc4  # XXX may be AES
-        return
+            return None
+        return key
+
+    def authenticate_sha256(self, password, param, R):
+        '''Computes the encryption key of revision 5-6 from
+        the user password or the owner password.
+        Returns None if the password is incorrect.'''
+        if sha256 is None:
+            raise PDFEncryptionError('AES-256 encryption requires hashlib')
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        password = password[:127]
+        O = str_value(param['O'])
+        U = str_value(param['U'])
+        if R == 5:
+            hash = hash_rev5
+        else:
+            hash = hash_rev6
+        # Algorithm 3.2a (PDF 2.0: Algorithm 2.A)
+        if hash(password, U[32:40]) == U[:32]:
+            key = hash(password, U[40:48])
+            encrypted = str_value(param['UE'])
+        elif hash(password, O[32:40], U[:48]) == O[:32]:
+            key = hash(password, O[40:48], U[:48])
+            encrypted = str_value(param['OE'])
+        else:
+            return None
+        return RijndaelDecryptor(key, 256).decrypt_cbc('\x00'*16, encrypted[:32])
+
+    CRYPT_FILTER_METHODS = ('None', 'V2', 'AESV2', 'AESV3')
+    def get_crypt_filter(self, param, name):
+        '''Returns the decipher function of a crypt filter.'''
+        if name is None or literal_name(name) == 'Identity':
+            return None
+        cf = dict_value(dict_value(param.get('CF', {})).get(literal_name(name), {}))
+        method = literal_name(cf.get('CFM', LIT('None')))
+        if method not in self.CRYPT_FILTER_METHODS:
+            raise PDFEncryptionError('Unknown crypt filter method: %r' % method)
+        if method == 'V2':
+            return self.decrypt_rc4
+        elif method == 'AESV2':
+            return self.decrypt_aes128
+        elif method == 'AESV3':
+            return self.decrypt_aes256
+        return None
 
     def decrypt_rc4(self, objid, genno, data):
-        key = self.decrypt_key + struct.pack('<L',objid)[:3]+struct.pack('<L',genno)[:2]
-        hash = md5.md5(key)
-        key = hash.digest()[:min(len(key),16)]
-        return Arcfour(key).process(data)
+        # The key schedule of an object is reused while it is
+        # in the cache (the strings and the stream of an object
+        # are deciphered one after another).
+        try:
+            rc4 = self.rc4cache[(objid, genno)]
+        except KeyError:
+            key = self.decrypt_key + struct.pack('<L',objid)[:3]+struct.pack('<L',genno)[:2]
+            hash = md5.md5(key)
+            key = hash.digest()[:min(len(key),16)]
+            rc4 = self.rc4cache[(objid, genno)] = Arcfour(key)
+        return rc4.copy().process(data)
+
+    def decrypt_aes128(self, objid, genno, data):
+        # The key schedule of an object is reused while it is
+        # in the cache.
+        try:
+            aes = self.aescache[(objid, genno)]
+        except KeyError:
+            key = self.decrypt_key + struct.pack('<L',objid)[:3]+struct.pack('<L',genno)[:2]
+            hash = md5.md5(key + 'sAlT')
+            aes = self.aescache[(objid, genno)] = RijndaelDecryptor(hash.digest(), 128)
+        return aes_cbc_decrypt(aes, data)
+
+    def decrypt_aes256(self, objid, genno, data):
+        # All the objects share the same key.
+        try:
+            aes = self.aescache[None]
+        except KeyError:
+            aes = self.aescache[None] = RijndaelDecryptor(self.decrypt_key, 256)
+        return aes_cbc_decrypt(aes, data)
 
     KEYWORD_OBJ = KWD('obj')
     def getobj(self, objid):
@@ -407,17 +1010,12 @@ class PDFDocument(object):
             raise PDFException('PDFDocument is not initialized')
         if 2 <= self.debug:
             print >>stderr, 'getobj: objid=%r' % (objid)
-        if objid in self.objs:
-            genno = 0
-            obj = self.objs[objid]
-        else:
-            for xref in self.xrefs:
-                try:
-                    (strmid, index) = xref.get_pos(objid)
-                    break
-                except KeyError:
-                    pass
-            else:
+        try:
+            obj = self.objcache[objid]
+        except KeyError:
+            try:
+                (strmid, index) = self.xrefindex.get_pos(objid)
+            except KeyError:
                 if STRICT:
                     raise PDFSyntaxError('Cannot locate objid=%r' % objid)
                 # return null for a nonexistent reference.
@@ -427,31 +1025,21 @@ class PDFDocument(object):
                 if stream.get('Type') is not LITERAL_OBJSTM:
                     if STRICT:
                         raise PDFSyntaxError('Not a stream object: %r' % stream)
+                positions = self.get_objstm_positions(strmid, stream)
                 try:
-                    n = stream['N']
-                except KeyError:
-                    if STRICT:
-                        raise PDFSyntaxError('N is not defined: %r' % stream)
-                    n = 0
-                if strmid in self.parsed_objs:
-                    objs = self.parsed_objs[strmid]
-                else:
-                    parser = PDFStreamParser(stream.get_data())
-                    parser.set_document(self)
-                    objs = []
-                    try:
-                        while 1:
-                            (_,obj) = parser.nextobject()
-                            objs.append(obj)
-                    except PSEOF:
-                        pass
-                    self.parsed_objs[strmid] = objs
-                genno = 0
-                i = n*2+index
-                try:
-                    obj = objs[i]
+                    pos = positions[index]
                 except IndexError:
                     raise PDFSyntaxError('Invalid object number: objid=%r' % (objid))
+                # parse only the requested object.
+                parser = PDFStreamParser(self.get_objstm_data(strmid, stream))
+                parser.set_document(self)
+                parser.seek(pos)
+                try:
+                    (_,obj) = parser.nextobject()
+                except PSEOF:
+                    raise PDFSyntaxError('Invalid object number: objid=%r' % (objid))
+                # The strings in an object stream are not encrypted
+                # individually; the stream itself is.
                 if isinstance(obj, PDFStream):
                     obj.set_objid(objid, 0)
             else:
@@ -475,27 +1063,88 @@ class PDFDocument(object):
                 (_,obj) = self._parser.nextobject()
                 if isinstance(obj, PDFStream):
                     obj.set_objid(objid, genno)
+                elif self.decipher:
+                    # The deciphered object is cached
+                    # so that it is deciphered only once.
+                    obj = decipher_all(self.decipher, objid, genno, obj)
             if 2 <= self.debug:
                 print >>stderr, 'register: objid=%r: %r' % (objid, obj)
-            self.objs[objid] = obj
-        if self.decipher:
-            obj = decipher_all(self.decipher, objid, genno, obj)
+            self.objcache[objid] = obj
         return obj
 
+    def get_objstm_positions(self, strmid, stream):
+        """Returns the positions of the objects in an object stream.
+
+        The header of the stream (N pairs of objid and offset from /First)
+        is read once and kept in the object cache, so that each object
+        can be parsed separately when it is requested.
+        """
+        key = (LITERAL_OBJSTM, strmid)
+        try:
+            return self.objcache[key]
+        except KeyError:
+            pass
+        try:
+            n = int_value(stream['N'])
+        except KeyError:
+            if STRICT:
+                raise PDFSyntaxError('N is not defined: %r' % stream)
+            n = 0
+        parser = PDFStreamParser(self.get_objstm_data(strmid, stream))
+        offsets = []
+        first = resolve1(stream.get('First'))
+        try:
+            for _ in xrange(n):
+                (_,objid) = parser.nexttoken()
+                (_,offset) = parser.nexttoken()
+                if not isinstance(objid, int) or not isinstance(offset, int) or offset < 0:
+                    if STRICT:
+                        raise PDFSyntaxError('Invalid object stream header: %r' % stream)
+                    break
+                offsets.append(offset)
+            if not isinstance(first, int) or first < 0:
+                # assume the objects follow the header.
+                (first,_) = parser.nexttoken()
+        except PSEOF:
+            if not isinstance(first, int) or first < 0:
+                first = 0
+        positions = array('L', ( first+offset for offset in offsets ))
+        self.objcache[key] = positions
+        return positions
+
+    def get_objstm_data(self, strmid, stream):
+        """Returns the decoded data of an object stream.
+
+        The data of the last object stream is kept here, as the data
+        larger than maxitembytes is not kept in the data cache.
+        """
+        if self._objstm is not None and self._objstm[0] == strmid:
+            return self._objstm[1]
+        data = stream.get_data()
+        self._objstm = (strmid, data)
+        return data
+
     INHERITABLE_ATTRS = set(['Resources', 'MediaBox', 'CropBox', 'Rotate'])
+    def get_pagenode(self, obj, parent):
+        "Returns (objid, attrs) of a page tree node with the inherited attributes."
+        if isinstance(obj, int):
+            objid = obj
+            tree = dict_value(self.getobj(objid)).copy()
+        else:
+            objid = obj.objid
+            tree = dict_value(obj).copy()
+        for (k,v) in parent.iteritems():
+            if k in self.INHERITABLE_ATTRS and k not in tree:
+                tree[k] = v
+        if tree.get('Type') is LITERAL_PAGES:
+            self.objcache.pin(objid)
+        return (objid, tree)
+
     def get_pages(self):
         if not self.xrefs:
             raise PDFException('PDFDocument is not initialized')
         def search(obj, parent):
-            if isinstance(obj, int):
-                objid = obj
-                tree = dict_value(self.getobj(objid)).copy()
-            else:
-                objid = obj.objid
-                tree = dict_value(obj).copy()
-            for (k,v) in parent.iteritems():
-                if k in self.INHERITABLE_ATTRS and k not in tree:
-                    tree[k] = v
+            (objid, tree) = self.get_pagenode(obj, parent)
             if tree.get('Type') is LITERAL_PAGES and 'Kids' in tree:
                 if 1 <= self.debug:
                     print >>stderr, 'Pages: Kids=%r' % tree['Kids']
@@ -506,9 +1155,117 @@ class PDFDocument(object):
                 if 1 <= self.debug:
                     print >>stderr, 'Page: %r' % tree
                 yield (objid, tree)
+        if self.cachedpages is not None:
+            for (pageid,tree) in self.cachedpages:
+                yield PDFPage(self, pageid, decode_obj(self, tree))
+            return
+        if self.pagelist is not None:
+            for (pageid,tree) in self.pagelist:
+                yield PDFPage(self, pageid, tree)
+            return
         if 'Pages' not in self.catalog: return
+        # The page list is cached only for unencrypted documents
+        # so that no deciphered data is written to the disk.
+        pages = None
+        if self.indexcache and not self.encryption:
+            pages = []
         for (pageid,tree) in search(self.catalog['Pages'], self.catalog):
+            if pages is not None:
+                try:
+                    pages.append((pageid, encode_obj(tree)))
+                except PDFCacheError, e:
+                    if self.debug:
+                        print >>stderr, 'get_pages: not cached: %s' % e
+                    pages = None
             yield PDFPage(self, pageid, tree)
+        if pages is not None:
+            self.cachedpages = pages
+            self.save_index()
+        return
+
+    def get_page_count(self):
+        "Returns the number of pages, using the /Count of the page tree root."
+        if not self.xrefs:
+            raise PDFException('PDFDocument is not initialized')
+        if self.cachedpages is not None:
+            return len(self.cachedpages)
+        if self.pagelist is not None:
+            return len(self.pagelist)
+        if 'Pages' not in self.catalog: return 0
+        count = resolve1(dict_value(self.catalog['Pages']).get('Count'))
+        if isinstance(count, int) and 0 <= count:
+            return count
+        # /Count is broken; count the pages one by one.
+        n = 0
+        for _ in self.get_pages():
+            n += 1
+        return n
+
+    def get_page(self, pageno):
+        """Returns the page at the given index (0-origin).
+
+        The page tree is descended with the /Count of each node,
+        so only the nodes on the path to the page and the kids before
+        it are read. When the descent does not end at the page
+        (/Count is wrong), the whole tree is walked instead.
+        Raises IndexError if there is no such page.
+        """
+        if not self.xrefs:
+            raise PDFException('PDFDocument is not initialized')
+        if pageno < 0:
+            raise IndexError(pageno)
+        if self.cachedpages is not None:
+            (pageid,tree) = self.cachedpages[pageno]
+            return PDFPage(self, pageid, decode_obj(self, tree))
+        if self.pagelist is not None:
+            (objid, tree) = self.pagelist[pageno]
+            return PDFPage(self, objid, tree)
+        if 'Pages' not in self.catalog:
+            raise IndexError(pageno)
+        self.ndirect += 1
+        if self.DIRECT_PAGES < self.ndirect:
+            # many pages are requested; walking the tree is cheaper.
+            return self.get_page_linear(pageno)
+        (objid, tree) = self.get_pagenode(self.catalog['Pages'], self.catalog)
+        n = pageno
+        while tree.get('Type') is LITERAL_PAGES and 'Kids' in tree:
+            for c in list_value(tree['Kids']):
+                if isinstance(c, int):
+                    kid = dict_value(self.getobj(c))
+                else:
+                    kid = dict_value(c)
+                if kid.get('Type') is LITERAL_PAGE:
+                    count = 1
+                elif kid.get('Type') is LITERAL_PAGES and 'Kids' in kid:
+                    count = resolve1(kid.get('Count'))
+                    if not isinstance(count, int) or count < 0:
+                        # /Count is broken; walk the whole tree instead.
+                        return self.get_page_linear(pageno)
+                else:
+                    count = 0
+                if n < count:
+                    (objid, tree) = self.get_pagenode(c, tree)
+                    break
+                n -= count
+            else:
+                # the kids have fewer pages than /Count says.
+                return self.get_page_linear(pageno)
+        if tree.get('Type') is not LITERAL_PAGE or n != 0:
+            return self.get_page_linear(pageno)
+        if 1 <= self.debug:
+            print >>stderr, 'Page: %r' % tree
+        return PDFPage(self, objid, tree)
+
+    def get_page_linear(self, pageno):
+        self.load_pages()
+        (objid, tree) = self.pagelist[pageno]
+        return PDFPage(self, objid, tree)
+
+    def load_pages(self):
+        """Walks the whole page tree once and keeps the pages,
+        so that get_page() does not descend the tree any more."""
+        if self.pagelist is None and self.cachedpages is None:
+            self.pagelist = [ (page.pageid, page.attrs) for page in self.get_pages() ]
         return
 
     def get_outlines(self):
@@ -564,6 +1321,9 @@ class PDFParser(PSStackParser):
     It can handle indirect references by referring to
     a PDF document set by set_document method.
     It also reads XRefs at the end of every PDF file.
+    Instead of a file object, it can take an mmap object
+    (or a string) that holds the entire file. The data is
+    then tokenized in place without any chunked reads.
 
     Typical usage:
       parser = PDFParser(fp)
@@ -577,6 +1337,8 @@ class PDFParser(PSStackParser):
     def __init__(self, fp):
         PSStackParser.__init__(self, fp)
         self.doc = None
+        # the PDFXRefFallback being loaded, if any.
+        self.fallback = None
         return
 
     def set_document(self, doc):
@@ -584,12 +1346,17 @@ class PDFParser(PSStackParser):
         self.doc = doc
         return
 
+    # the body of a stream is skipped with /Length, and an object
+    # is usually followed by a seek to the next one.
+    REGEX_STOPWORDS = frozenset(['stream', 'endobj'])
+
     KEYWORD_R = KWD('R')
     KEYWORD_NULL = KWD('null')
     KEYWORD_ENDOBJ = KWD('endobj')
     KEYWORD_STREAM = KWD('stream')
     KEYWORD_XREF = KWD('xref')
     KEYWORD_STARTXREF = KWD('startxref')
+    ENDSTREAM_CUE = re.compile(r'\s*endstream')
     def do_keyword(self, pos, token):
         """Handles PDF-related keywords."""
         
@@ -618,7 +1385,11 @@ class PDFParser(PSStackParser):
             ((_,dic),) = self.pop(1)
             dic = dict_value(dic)
             try:
-                objlen = int_value(dic['Length'])
+                objlen = dic['Length']
+                if isinstance(objlen, PDFObjRef) and self.fallback is not None:
+                    # the document cannot resolve it yet.
+                    objlen = self.fallback.read_int_at(self, objlen.objid)
+                objlen = int_value(objlen)
             except KeyError:
                 if STRICT:
                     raise PDFSyntaxError('/Length is undefined: %r' % dic)
@@ -631,28 +1402,33 @@ class PDFParser(PSStackParser):
                     raise PDFSyntaxError('Unexpected EOF')
                 return
             pos += len(line)
-            self.fp.seek(pos)
-            data = self.fp.read(objlen)
-            self.seek(pos+objlen)
-            while 1:
-                try:
-                    (linepos, line) = self.nextline()
-                except PSEOF:
-                    if STRICT:
-                        raise PDFSyntaxError('Unexpected EOF')
-                    break
-                if 'endstream' in line:
-                    i = line.index('endstream')
-                    objlen += i
-                    data += line[:i]
-                    break
-                objlen += len(line)
-                data += line
+            # The stream body is not read here. Only its location
+            # is recorded. If /Length does not point at 'endstream',
+            # scan the lines for it to find the actual length.
+            if not self.ENDSTREAM_CUE.match(self.fetch(pos+objlen, 64)):
+                self.seek(pos+objlen)
+                while 1:
+                    try:
+                        (linepos, line) = self.nextline()
+                    except PSEOF:
+                        if STRICT:
+                            raise PDFSyntaxError('Unexpected EOF')
+                        break
+                    if 'endstream' in line:
+                        i = line.index('endstream')
+                        objlen += i
+                        break
+                    objlen += len(line)
             self.seek(pos+objlen)
             if 1 <= self.debug:
-                print >>stderr, 'Stream: pos=%d, objlen=%d, dic=%r, data=%r...' % \
-                      (pos, objlen, dic, data[:10])
-            obj = PDFStream(dic, data, self.doc.decipher)
+                print >>stderr, 'Stream: pos=%d, objlen=%d, dic=%r' % \
+                      (pos, objlen, dic)
+            decipher = self.doc.stream_decipher
+            if dic.get('Type') is LITERAL_METADATA and not self.doc.encrypt_metadata:
+                decipher = None
+            obj = PDFStream(dic, None, decipher)
+            obj.set_source(self, pos, objlen)
+            obj.set_cache(self.doc.datacache)
             self.push((pos, obj))
 
         else:
@@ -724,8 +1500,8 @@ class PDFParser(PSStackParser):
             # fallback
             if 1 <= self.debug:
                 print >>stderr, 'no xref, fallback'
-            xref = PDFXRef()
-            xref.load_fallback(self)
+            xref = PDFXRefFallback()
+            xref.load(self, debug=self.debug)
             xrefs.append(xref)
         return xrefs
 
@@ -743,7 +1519,7 @@ class PDFStreamParser(PDFParser):
     """
 
     def __init__(self, data):
-        PDFParser.__init__(self, StringIO(data))
+        PDFParser.__init__(self, data)
         return
 
     def flush(self):
@@ -1,13 +1,22 @@
 #!/usr/bin/env python
 import sys
 import zlib
-from lzw import lzwdecode
-from ascii85 import ascii85decode, asciihexdecode
-from runlength import rldecode
-from psparser import PSException, PSObject
+import warnings
+from array import array
+from lzw import iter_lzwdecode
+from ascii85 import iter_ascii85decode, iter_asciihexdecode
+from runlength import iter_rldecode
+from predictor import iter_pngpredict, iter_tiffpredict
+try:
+    import hashlib as md5
+except ImportError:
+    import md5
+from psparser import PSException, PSObject, PSLiteral, PSKeyword
 from psparser import LIT, KWD, STRICT
+from utils import LRUCache
 
 LITERAL_CRYPT = LIT('Crypt')
+LITERAL_IDENTITY = LIT('Identity')
 
 # Abbreviation of Filter names in PDF 4.8.6. "Inline Images"
 LITERALS_FLATE_DECODE = (LIT('FlateDecode'), LIT('Fl'))
@@ -19,6 +28,73 @@ LITERALS_CCITTFAX_DECODE = (LIT('CCITTFaxDecode'), LIT('CCF'))
 LITERALS_DCT_DECODE = (LIT('DCTDecode'), LIT('DCT'))
 
 
+##  Incremental decoders
+##
+
+# iter_flatedecode(chunks, bufsize=65536)
+def iter_flatedecode(chunks, bufsize=65536, report=None):
+    """Decompresses an iterable of zlib-compressed strings incrementally.
+    The output is yielded in chunks of at most bufsize bytes.
+
+    Some FlateDecode streams are broken or have garbage (newlines, etc)
+    appended to the end. In that case, everything before the broken
+    part is yielded, and report (if given) is called with the number
+    of compressed bytes that were consumed and the number of bytes
+    recovered.
+
+    >>> data = zlib.compress('abcdefgh'*1000)
+    >>> len(''.join(iter_flatedecode([data[:20], data[20:]], 1000)))
+    8000
+    >>> def report(nin, nout): print nin, nout
+    >>> len(''.join(iter_flatedecode([data[:-4]+'\\0\\0\\0\\0'], report=report)))
+    41 8000
+    8000
+    """
+    dco = zlib.decompressobj()
+    nin = nout = 0
+    for data in chunks:
+        while data:
+            prev = dco.copy()
+            try:
+                out = dco.decompress(data, bufsize)
+            except zlib.error:
+                # find the broken part by feeding the chunk
+                # in smaller and smaller pieces.
+                out = []
+                i = 0
+                step = len(data)
+                while step:
+                    dco = prev.copy()
+                    try:
+                        x = dco.decompress(data[i:i+step])
+                    except zlib.error:
+                        step /= 2
+                        continue
+                    out.append(x)
+                    prev = dco
+                    i += step
+                nin += i
+                if nin < 8:
+                    raise PDFValueError('zlib.error while decompressing data')
+                out = ''.join(out)
+                nout += len(out)
+                for j in xrange(0, len(out), bufsize):
+                    yield out[j:j+bufsize]
+                if report is not None:
+                    report(nin, nout)
+                return
+            yield out
+            nout += len(out)
+            if dco.unused_data or (not out and len(dco.unconsumed_tail) == len(data)):
+                # the end of the stream.
+                # (the trailing garbage might be left in unconsumed_tail.)
+                return
+            nin += len(data)-len(dco.unconsumed_tail)
+            data = dco.unconsumed_tail
+    yield dco.flush()
+    return
+
+
 ##  PDF Objects
 ##
 class PDFObject(PSObject): pass
@@ -28,6 +104,11 @@ class PDFTypeError(PDFException): pass
 class PDFValueError(PDFException): pass
 class PDFNotImplementedError(PSException): pass
 
+# Issued when a broken stream is partially decoded.
+# To turn it into an exception:
+#   warnings.simplefilter('error', PDFDecodeWarning)
+class PDFDecodeWarning(UserWarning): pass
+
 
 ##  PDFObjRef
 ##
@@ -149,6 +230,17 @@ def stream_value(x):
 ##
 class PDFStream(PDFObject):
 
+    """A PDF stream object.
+
+    The raw data is either given directly or, when set_source()
+    is used, read lazily from a parser (anything that has a
+    fetch(pos, n) method) the first time it is needed.
+
+    When a PDFStreamCache is given with set_cache(), the decoded
+    data is kept in the cache instead of the stream object, so that
+    it can be discarded and decoded again later.
+    """
+
     def __init__(self, attrs, rawdata, decipher=None):
         assert isinstance(attrs, dict)
         self.attrs = attrs
@@ -157,6 +249,10 @@ class PDFStream(PDFObject):
         self.data = None
         self.objid = None
         self.genno = None
+        self.source = None
+        # (consumed, recovered) bytes of a broken stream.
+        self.recovered = None
+        self.cache = None
         return
 
     def set_objid(self, objid, genno):
@@ -164,13 +260,37 @@ class PDFStream(PDFObject):
         self.genno = genno
         return
 
+    def set_source(self, parser, pos, length):
+        self.source = (parser, pos, length)
+        return
+
+    def set_cache(self, cache):
+        self.cache = cache
+        return
+
+    def uncache(self):
+        """Discards the decoded data kept in the cache."""
+        key = self.get_cachekey()
+        if key is not None and key in self.cache:
+            del self.cache[key]
+        return
+
+    def get_cachekey(self):
+        # An object can be redefined by an incremental update,
+        # so the position of the raw data is also a part of the key.
+        if self.cache is None or self.objid is None or self.source is None:
+            return None
+        return (self.objid, self.genno, self.source[1])
+
     def __repr__(self):
-        if self.data is None:
-            assert self.rawdata is not None
+        if self.data is not None:
+            return '<PDFStream(%r): len=%d, %r>' % (self.objid, len(self.data), self.attrs)
+        elif self.rawdata is not None:
             return '<PDFStream(%r): raw=%d, %r>' % (self.objid, len(self.rawdata), self.attrs)
         else:
-            assert self.data is not None
-            return '<PDFStream(%r): len=%d, %r>' % (self.objid, len(self.data), self.attrs)
+            assert self.source is not None
+            (_, pos, length) = self.source
+            return '<PDFStream(%r): pos=%d, raw=%d, %r>' % (self.objid, pos, length, self.attrs)
 
     def __contains__(self, name):
         return name in self.attrs
@@ -193,76 +313,320 @@ class PDFStream(PDFObject):
         if isinstance(filters, list): return filters
         return [ filters ]
 
-    def decomp(self,data):
-        buf = data
-        # some FlateDecode streams have garbage (newlines, etc) appended to the
-        # end.  remove chars from the end to try and decompress the buffer
-        while 8 <= len(buf):
-            try:
-                # will get errors if the document is encrypted.
-                dco = zlib.decompressobj()
-                return dco.decompress(buf)
-            except zlib.error:
-                buf = buf[:-1]
-        raise Exception, "zlib.error while decompressing data"
+    def get_params(self):
+        """Returns a list of the decode parameters for each filter."""
+        filters = self.get_filters()
+        params = resolve1(self.get_any(('DP', 'DecodeParms', 'FDecodeParms'), {}))
+        if isinstance(params, list):
+            params = [ resolve1(x) for x in params ]
+        else:
+            # a single dictionary is shared by all the filters.
+            params = [ params ] * len(filters)
+        return [ x if isinstance(x, dict) else {} for x in params ]
+
+    def get_crypt(self):
+        """Returns the decipher function, and the filters and their
+        parameters that follow a /Crypt filter, if any."""
+        decipher = self.decipher
+        filters = self.get_filters()
+        params = self.get_params()
+        if filters and filters[0] == LITERAL_CRYPT:
+            # A /Crypt filter overrides the default crypt filter of the
+            # document. Only /Identity (the default name) turns off the
+            # decryption; other filter names use the default one.
+            if not params or resolve1(params[0].get('Name', LITERAL_IDENTITY)) == LITERAL_IDENTITY:
+                decipher = None
+            filters = filters[1:]
+            params = params[1:]
+        return (decipher, filters, params)
 
     def decode(self):
-        assert self.data is None and self.rawdata != None
-        data = self.rawdata
-        if self.decipher:
-            # Handle encryption
-            data = self.decipher(self.objid, self.genno, data)
-        filters = self.get_filters()
-        if not filters:
-            self.data = data
-            self.rawdata = None
+        assert self.data is None
+        self.data = ''.join(self.iter_decode())
+        self.rawdata = None
+        return
+
+    def iter_data(self, chunk_size=65536):
+        """Yields the decoded data in chunks.
+
+        Each filter decodes its input incrementally, so neither the
+        raw data nor the decoded data is kept in memory as a whole
+        (except that encrypted data is deciphered at once).
+        The decoded data is not stored in the stream object, but it
+        is stored in the cache if the stream has one.
+        """
+        data = self.data
+        key = self.get_cachekey()
+        if data is None and key is not None:
+            data = self.cache.get(key)
+        if data is not None:
+            for i in xrange(0, len(data), chunk_size):
+                yield data[i:i+chunk_size]
+            return
+        if key is None:
+            for data in self.iter_decode(chunk_size):
+                yield data
             return
-        for f in filters:
+        # collect the chunks for the cache unless they get too large.
+        chunks = []
+        size = 0
+        for data in self.iter_decode(chunk_size):
+            yield data
+            size += len(data)
+            if chunks is not None:
+                if size <= self.cache.maxitembytes:
+                    chunks.append(data)
+                else:
+                    chunks = None
+        if chunks is not None:
+            self.cache.store(key, ''.join(chunks))
+        else:
+            self.cache.record(size)
+        return
+
+    def iter_decode(self, chunk_size=65536):
+        """Decodes the raw data and yields the result in chunks."""
+        (decipher, filters, params) = self.get_crypt()
+        chunks = self.iter_rawdata(chunk_size)
+        if decipher:
+            # Handle encryption
+            data = decipher(self.objid, self.genno, ''.join(chunks))
+            chunks = ( data[i:i+chunk_size] for i in xrange(0, len(data), chunk_size) )
+        for (i,f) in enumerate(filters):
             if f in LITERALS_FLATE_DECODE:
                 # will get errors if the document is encrypted.
-                data = self.decomp(data)
+                chunks = iter_flatedecode(chunks, chunk_size, self.report_broken)
             elif f in LITERALS_LZW_DECODE:
-                data = lzwdecode(data)
+                early = int_value(params[i].get('EarlyChange', 1)) if i < len(params) else 1
+                chunks = iter_lzwdecode(chunks, chunk_size, early)
             elif f in LITERALS_ASCII85_DECODE:
-                data = ascii85decode(data)
+                chunks = iter_ascii85decode(chunks)
             elif f in LITERALS_ASCIIHEX_DECODE:
-                data = asciihexdecode(data)
+                chunks = iter_asciihexdecode(chunks)
             elif f in LITERALS_RUNLENGTH_DECODE:
-                data = rldecode(data)
+                chunks = iter_rldecode(chunks)
             elif f in LITERALS_CCITTFAX_DECODE:
-                #data = ccittfaxdecode(data)
                 raise PDFNotImplementedError('Unsupported filter: %r' % f)
             elif f == LITERAL_CRYPT:
-                # not yet..
-                raise PDFNotImplementedError('/Crypt filter is unsupported')
+                raise PDFNotImplementedError('/Crypt filter must come first')
             else:
                 raise PDFNotImplementedError('Unsupported filter: %r' % f)
             # apply predictors
-            params = self.get_any(('DP', 'DecodeParms', 'FDecodeParms'), {})
-            if 'Predictor' in params and 'Columns' in params:
-                pred = int_value(params['Predictor'])
-                columns = int_value(params['Columns'])
-                if pred:
-                    if pred != 12:
-                        raise PDFNotImplementedError('Unsupported predictor: %r' % pred)
-                    buf = ''
-                    ent0 = '\x00' * columns
-                    for i in xrange(0, len(data), columns+1):
-                        pred = data[i]
-                        ent1 = data[i+1:i+1+columns]
-                        if pred == '\x02':
-                            ent1 = ''.join( chr((ord(a)+ord(b)) & 255) for (a,b) in zip(ent0,ent1) )
-                        buf += ent1
-                        ent0 = ent1
-                    data = buf
-        self.data = data
-        self.rawdata = None
+            if f in LITERALS_FLATE_DECODE or f in LITERALS_LZW_DECODE:
+                chunks = self.apply_predictor(chunks, params[i] if i < len(params) else {})
+        for data in chunks:
+            if data:
+                yield data
+        return
+
+    def report_broken(self, consumed, recovered):
+        self.recovered = (consumed, recovered)
+        warnings.warn('Broken FlateDecode stream %r: %d bytes recovered from %d bytes' %
+                      (self.objid, recovered, consumed), PDFDecodeWarning)
         return
 
+    def apply_predictor(self, chunks, params):
+        pred = int_value(params.get('Predictor', 1))
+        if pred <= 1: return chunks
+        colors = int_value(params.get('Colors', 1))
+        columns = int_value(params.get('Columns', 1))
+        bits = int_value(params.get('BitsPerComponent', 8))
+        if pred == 2:
+            return iter_tiffpredict(chunks, colors, columns, bits)
+        elif 10 <= pred <= 15:
+            return iter_pngpredict(chunks, colors, columns, bits)
+        raise PDFNotImplementedError('Unsupported predictor: %r' % pred)
+
     def get_data(self):
-        if self.data is None:
+        if self.data is not None:
+            return self.data
+        key = self.get_cachekey()
+        if key is None:
             self.decode()
-        return self.data
+            return self.data
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        data = ''.join(self.iter_decode())
+        self.cache.store(key, data)
+        return data
 
     def get_rawdata(self):
+        if self.rawdata is None and self.source is not None:
+            (parser, pos, length) = self.source
+            self.rawdata = parser.fetch(pos, length)
         return self.rawdata
+
+    def iter_rawdata(self, chunk_size=65536):
+        """Yields the raw data in chunks. When the raw data has not
+        been read yet, it is read from the source chunk by chunk."""
+        if self.rawdata is not None or self.source is None:
+            data = self.rawdata or ''
+            for i in xrange(0, len(data), chunk_size):
+                yield data[i:i+chunk_size]
+            return
+        (parser, pos, length) = self.source
+        for i in xrange(0, length, chunk_size):
+            data = parser.fetch(pos+i, min(chunk_size, length-i))
+            if not data: break
+            yield data
+        return
+
+
+##  PDFStreamCache
+##
+class PDFStreamCache(LRUCache):
+
+    """A cache of decoded stream data shared by the streams of a document.
+
+    The cache is keyed by (objid, genno, pos) and bounded by maxbytes of
+    decoded data. Data larger than maxitembytes is not cached at all.
+    A stream whose data has been evicted is decoded again from its
+    raw data, which is read from the file again unless it is
+    kept in memory. In addition to the stats of LRUCache,
+    the number of decodings and the bytes decoded are counted.
+
+    >>> cache = PDFStreamCache(maxbytes=10, maxitembytes=6)
+    >>> cache.store(1, 'abcde'); cache.store(2, 'fghij'); cache.store(3, 'toolarge')
+    >>> cache.store(4, 'k')
+    >>> sorted(cache.links)
+    [2, 4]
+    >>> (cache.decodes, cache.decoded, cache.evictions)
+    (4, 19, 1)
+    """
+
+    def __init__(self, maxbytes, maxitembytes=None):
+        if maxitembytes is None:
+            maxitembytes = maxbytes/4
+        self.maxitembytes = maxitembytes
+        LRUCache.__init__(self, maxbytes=maxbytes, sizefunc=len)
+        return
+
+    def __repr__(self):
+        return ('<PDFStreamCache: entries=%d, bytes=%d, decoded=%d>' %
+                (len(self.links), self.nbytes, self.decoded))
+
+    def reset_stats(self):
+        LRUCache.reset_stats(self)
+        self.decodes = self.decoded = 0
+        return
+
+    def get_stats(self):
+        stats = LRUCache.get_stats(self)
+        stats['decodes'] = self.decodes
+        stats['decoded'] = self.decoded
+        return stats
+
+    def record(self, nbytes):
+        """Counts a decoding of nbytes."""
+        self.decodes += 1
+        self.decoded += nbytes
+        return
+
+    def store(self, key, data):
+        """Counts a decoding and caches the data if it is not too large."""
+        self.record(len(data))
+        if len(data) <= self.maxitembytes:
+            self[key] = data
+        return
+
+
+# estimate_size
+def estimate_size(x):
+    '''Roughly estimates the memory used by a PDF object in bytes.
+    Referenced objects are not counted. Only the data of a stream
+    that is held by the stream itself is counted; the data that has
+    not been read yet, or that is kept in a datacache, is not.
+
+    >>> strm = PDFStream({}, None)
+    >>> strm.set_source(None, 0, 1000000)
+    >>> estimate_size(strm) < 1000
+    True
+    >>> estimate_size(PDFStream({}, 'x'*1000000)) > 1000000
+    True
+    '''
+    if isinstance(x, str):
+        return 40+len(x)
+    if isinstance(x, (list, tuple)):
+        return 72+sum( 8+estimate_size(v) for v in x )
+    if isinstance(x, dict):
+        return 280+sum( 48+estimate_size(v) for v in x.itervalues() )
+    if isinstance(x, array):
+        return 64+x.itemsize*len(x)
+    if isinstance(x, PDFStream):
+        size = 100+estimate_size(x.attrs)
+        if x.data is not None:
+            size += len(x.data)
+        if x.rawdata is not None:
+            size += len(x.rawdata)
+        return size
+    return 32
+
+# digest_obj
+def digest_obj(x):
+    '''Returns the MD5 digest of the contents of a PDF object.
+    Indirect references are followed, so that the same contents
+    have the same digest in any document. The raw data of a stream
+    is used unless the stream is encrypted.
+
+    >>> digest_obj({'a': [1, 2.0, 'x']}) == digest_obj({'a': [1, 2.0, 'x']})
+    True
+    >>> digest_obj([1, 2]) == digest_obj([2, 1])
+    False
+    '''
+    hash = md5.md5()
+    # the objects visited; a cyclic reference is replaced
+    # by the order in which the object was first visited.
+    visited = {}
+    def feed(x):
+        while isinstance(x, PDFObjRef):
+            if x.objid in visited:
+                hash.update('R%d;' % visited[x.objid])
+                return
+            visited[x.objid] = len(visited)
+            x = x.resolve()
+        if x is None:
+            hash.update('N;')
+        elif isinstance(x, bool):
+            hash.update('B%d;' % x)
+        elif isinstance(x, (int, long, float)):
+            hash.update('n%r;' % x)
+        elif isinstance(x, str):
+            hash.update('s%d:' % len(x))
+            hash.update(x)
+        elif isinstance(x, PSLiteral):
+            hash.update('L%r;' % x.name)
+        elif isinstance(x, PSKeyword):
+            hash.update('K%r;' % x.name)
+        elif isinstance(x, list):
+            hash.update('[')
+            for v in x:
+                feed(v)
+            hash.update(']')
+        elif isinstance(x, dict):
+            hash.update('{')
+            for k in sorted(x.iterkeys()):
+                feed(k)
+                feed(x[k])
+            hash.update('}')
+        elif isinstance(x, PDFStream):
+            hash.update('S')
+            feed(x.attrs)
+            if x.decipher is None:
+                chunks = x.iter_rawdata()
+            else:
+                chunks = [ x.get_data() ]
+            for data in chunks:
+                hash.update(data)
+            hash.update(';')
+        else:
+            hash.update('%r;' % x)
+        return
+    feed(x)
+    return hash.digest()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+""" Predictor functions for LZWDecode and FlateDecode filters.
+
+Supported predictors are the TIFF predictor 2 and the PNG predictors
+(10-15). A PNG predicted row begins with a byte that tells the filter
+type of the row (None, Sub, Up, Average or Paeth), regardless of
+the predictor number.
+
+Rows are processed as bytearrays. When NumPy is available,
+the Sub/Up filters and the TIFF predictor are done with array
+operations. A run of rows that all use the Up filter is
+decoded at once.
+
+"""
+
+from binascii import hexlify, unhexlify
+from array import array
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# get_rowsize(colors, columns, bits)
+#   Returns (bytes per row, bytes per pixel).
+def get_rowsize(colors, columns, bits):
+    return ((colors*bits*columns+7)/8, max(1, (colors*bits+7)/8))
+
+
+# add_bytes(a, b)
+#   Adds two strings bytewise (modulo 256) as big integers.
+#   The carries between bytes are suppressed by treating the high bit
+#   of each byte separately.
+HIGHBITS = {}
+def add_bytes(a, b):
+    """
+    >>> add_bytes('\\x01\\x80\\xff', '\\x02\\x80\\x02')
+    '\\x03\\x00\\x01'
+    """
+    n = len(a)
+    if not n: return ''
+    try:
+        h = HIGHBITS[n]
+    except KeyError:
+        h = HIGHBITS[n] = int('80'*n, 16)
+    x = int(hexlify(a), 16)
+    y = int(hexlify(b), 16)
+    return unhexlify('%0*x' % (2*n, ((x & ~h) + (y & ~h)) ^ ((x ^ y) & h)))
+
+
+# png_unfilter(ftype, row, prev, bpp)
+#   Reverses the PNG filter of a row. row is a string without
+#   the filter type byte, prev is the previous decoded row
+#   (a string of the same length). Returns the decoded row as a string.
+def png_unfilter(ftype, row, prev, bpp):
+    """
+    >>> png_unfilter(1, '\\x01\\x01\\x01\\x01', '\\x00\\x00\\x00\\x00', 1)
+    '\\x01\\x02\\x03\\x04'
+    >>> png_unfilter(2, '\\x01\\x01\\x01\\x01', '\\x01\\x02\\x03\\xff', 1)
+    '\\x02\\x03\\x04\\x00'
+    >>> png_unfilter(3, '\\x01\\x01\\x01\\x01', '\\x02\\x02\\x02\\x02', 2)
+    '\\x02\\x02\\x03\\x03'
+    >>> png_unfilter(4, '\\x01\\x01\\x01\\x01', '\\x02\\x05\\x02\\x05', 2)
+    '\\x03\\x06\\x04\\x07'
+    """
+    if ftype == 0:
+        # None
+        return row
+    if ftype == 2:
+        # Up
+        if numpy is not None and 64 <= len(row):
+            return (numpy.frombuffer(row, numpy.uint8) +
+                    numpy.frombuffer(prev, numpy.uint8)).tostring()
+        if 32 <= len(row):
+            return add_bytes(row, prev)
+        r = bytearray(row)
+        p = bytearray(prev)
+        for i in xrange(len(r)):
+            r[i] = (r[i] + p[i]) & 255
+        return str(r)
+    if ftype == 1:
+        # Sub
+        n = len(row)
+        if numpy is not None and 64 <= n and n % bpp == 0:
+            x = numpy.frombuffer(row, numpy.uint8).reshape(n/bpp, bpp)
+            return numpy.cumsum(x, axis=0, dtype=numpy.uint8).tostring()
+        r = bytearray(row)
+        for i in xrange(bpp, n):
+            r[i] = (r[i] + r[i-bpp]) & 255
+        return str(r)
+    if ftype == 3:
+        # Average
+        r = bytearray(row)
+        p = bytearray(prev)
+        for i in xrange(min(bpp, len(r))):
+            r[i] = (r[i] + (p[i] >> 1)) & 255
+        for i in xrange(bpp, len(r)):
+            r[i] = (r[i] + ((r[i-bpp] + p[i]) >> 1)) & 255
+        return str(r)
+    if ftype == 4:
+        # Paeth
+        r = bytearray(row)
+        p = bytearray(prev)
+        for i in xrange(min(bpp, len(r))):
+            r[i] = (r[i] + p[i]) & 255
+        for i in xrange(bpp, len(r)):
+            a = r[i-bpp]
+            b = p[i]
+            c = p[i-bpp]
+            pa = abs(b-c)
+            pb = abs(a-c)
+            pc = abs(a+b-c-c)
+            if pa <= pb and pa <= pc:
+                r[i] = (r[i] + a) & 255
+            elif pb <= pc:
+                r[i] = (r[i] + b) & 255
+            else:
+                r[i] = (r[i] + c) & 255
+        return str(r)
+    # unknown filter type; leave the row as it is.
+    return row
+
+
+# png_unfilter_up_rows(data, prev)
+#   Reverses the PNG Up filter of successive rows. Each row of data
+#   begins with a filter type byte. prev is the previous decoded row.
+def png_unfilter_up_rows(data, prev):
+    """
+    >>> png_unfilter_up_rows('\\x02\\x01\\xff\\x02\\x01\\x02', '\\x00\\x02')
+    '\\x01\\x01\\x02\\x03'
+    """
+    rowsize = len(prev)
+    if numpy is not None:
+        x = numpy.frombuffer(data, numpy.uint8).reshape(len(data)/(rowsize+1), rowsize+1)
+        x = x[:,1:].copy()
+        x[0] += numpy.frombuffer(prev, numpy.uint8)
+        return numpy.cumsum(x, axis=0, dtype=numpy.uint8).tostring()
+    # add each row to the previous one as big integers. (see add_bytes)
+    try:
+        h = HIGHBITS[rowsize]
+    except KeyError:
+        h = HIGHBITS[rowsize] = int('80'*rowsize, 16)
+    nh = ~h
+    hx = hexlify(data)
+    width = rowsize*2
+    fmt = '%%0%dx' % width
+    p = int(hexlify(prev), 16)
+    rows = []
+    for i in xrange(2, len(hx), width+2):
+        x = int(hx[i:i+width], 16)
+        p = ((x & nh) + (p & nh)) ^ ((x ^ p) & h)
+        rows.append(fmt % p)
+    return unhexlify(''.join(rows))
+
+
+# iter_pngpredict(chunks, colors=1, columns=1, bits=8)
+#   Reverses the PNG predictors of an iterable of strings.
+def iter_pngpredict(chunks, colors=1, columns=1, bits=8):
+    """
+    >>> list(iter_pngpredict(['\\x02\\x01\\x02\\x02\\x01', '\\x01\\x01\\x01'], columns=2))
+    ['\\x01\\x02', '\\x02\\x03', '\\x01']
+    """
+    (rowsize, bpp) = get_rowsize(colors, columns, bits)
+    prev = '\x00' * rowsize
+    rest = ''
+    for data in chunks:
+        if rest:
+            data = rest+data
+        n = len(data) - len(data) % (rowsize+1)
+        rows = []
+        i = 0
+        while i < n:
+            ftype = ord(data[i])
+            if ftype == 2:
+                # decode the successive Up rows at once.
+                j = i
+                while j < n and data[j] == '\x02':
+                    j += rowsize+1
+                if i+rowsize+1 < j:
+                    rows.append(png_unfilter_up_rows(data[i:j], prev))
+                    prev = rows[-1][-rowsize:]
+                    i = j
+                    continue
+            prev = png_unfilter(ftype, data[i+1:i+1+rowsize], prev, bpp)
+            rows.append(prev)
+            i += rowsize+1
+        rest = data[n:]
+        yield ''.join(rows)
+    if rest:
+        # a truncated row.
+        yield png_unfilter(ord(rest[0]), rest[1:], prev[:len(rest)-1], bpp)
+    return
+
+
+# tiff_unpredict(row, colors, bits)
+#   Reverses the horizontal differencing of a row (TIFF predictor 2).
+def tiff_unpredict(row, colors, bits):
+    """
+    >>> tiff_unpredict('\\x01\\x02\\x01\\x01\\xff\\x01', 2, 8)
+    '\\x01\\x02\\x02\\x03\\x01\\x04'
+    >>> tiff_unpredict('\\x00\\x01\\xff\\xff', 1, 16)
+    '\\x00\\x01\\x00\\x00'
+    >>> tiff_unpredict('\\x55', 1, 2)
+    'l'
+    """
+    if bits == 8:
+        n = len(row)
+        if numpy is not None and 64 <= n and n % colors == 0:
+            x = numpy.frombuffer(row, numpy.uint8).reshape(n/colors, colors)
+            return numpy.cumsum(x, axis=0, dtype=numpy.uint8).tostring()
+        r = bytearray(row)
+        for i in xrange(colors, n):
+            r[i] = (r[i] + r[i-colors]) & 255
+        return str(r)
+    if bits == 16:
+        n = len(row)/2
+        if numpy is not None and n % colors == 0:
+            x = numpy.frombuffer(row, '>u2', n).reshape(n/colors, colors)
+            return numpy.cumsum(x, axis=0, dtype=numpy.uint16).astype('>u2').tostring()+row[n*2:]
+        r = array('H', row[:n*2])
+        if array('H', '\x00\x01')[0] != 1:
+            r.byteswap()
+        for i in xrange(colors, n):
+            r[i] = (r[i] + r[i-colors]) & 0xffff
+        if array('H', '\x00\x01')[0] != 1:
+            r.byteswap()
+        return r.tostring()+row[n*2:]
+    # 1, 2 or 4 bits per component: handle the row as a big integer.
+    n = len(row)*8/bits
+    if not n: return row
+    mask = (1 << bits)-1
+    x = int(hexlify(row), 16)
+    samples = [ (x >> (i*bits)) & mask for i in xrange(n-1, -1, -1) ]
+    for i in xrange(colors, n):
+        samples[i] = (samples[i] + samples[i-colors]) & mask
+    x = 0
+    for v in samples:
+        x = (x << bits) | v
+    return unhexlify('%0*x' % (len(row)*2, x))
+
+
+# iter_tiffpredict(chunks, colors=1, columns=1, bits=8)
+#   Reverses the TIFF predictor 2 of an iterable of strings.
+def iter_tiffpredict(chunks, colors=1, columns=1, bits=8):
+    (rowsize, _) = get_rowsize(colors, columns, bits)
+    rest = ''
+    for data in chunks:
+        if rest:
+            data = rest+data
+        n = len(data) - len(data) % rowsize
+        yield ''.join( tiff_unpredict(data[i:i+rowsize], colors, bits)
+                       for i in xrange(0, n, rowsize) )
+        rest = data[n:]
+    if rest:
+        # a truncated row.
+        yield tiff_unpredict(rest, colors, bits)
+    return
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
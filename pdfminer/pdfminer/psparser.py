@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import sys
 import re
+import mmap
 from sys import stderr
 from utils import choplist
 
@@ -138,23 +139,82 @@ END_KEYWORD = re.compile(r'[#/%\[\]()<>{}\s]')
 END_STRING = re.compile(r'[()\134]')
 OCT_STRING = re.compile(r'[0-7]')
 ESC_STRING = { 'b':8, 't':9, 'n':10, 'f':12, 'r':13, '(':40, ')':41, '\\':92 }
+ESC_SEQ = re.compile(r'[0-7]{1,3}|.', re.DOTALL)
+# the master pattern used by the 'regex' tokenizer engine.
+# every alternative corresponds to one of the _parse_* states.
+TOKEN = re.compile(r'''
+  (?P<space>\s+)
+| (?P<comment>%[^\r\n]*)
+| (?P<literal>/(?:[^#/%\[\]()<>{}\s]|\#[0-9a-fA-F]{0,2})*)
+| (?P<number>[-+0-9][0-9]*(?:\.[0-9]*)?)
+| (?P<float>\.[0-9]*)
+| (?P<keyword>[A-Za-z][^#/%\[\]()<>{}\s]*)
+| (?P<string>\()
+| (?P<dictbegin><<)
+| (?P<hexstring><[\s0-9a-fA-F]+)
+| (?P<wopen><)
+| (?P<dictend>>>)
+| (?P<wclose>>)
+| (?P<other>.)
+''', re.VERBOSE | re.DOTALL)
+LITERAL_HEX = re.compile(r'#([0-9a-fA-F]{0,2})')
+# tokens that can only be terminated by the next character.
+TOKEN_NEEDS_LOOKAHEAD = frozenset(['comment', 'literal', 'number', 'float', 'keyword',
+                                   'hexstring', 'wopen', 'wclose'])
 class PSBaseParser(object):
 
     '''
     Most basic PostScript parser that performs only tokenization.
+
+    Two tokenizer engines are available. 'statemachine' (default)
+    feeds the buffer to a chain of _parse_* continuations, while
+    'regex' runs one compiled master pattern over a whole chunk
+    and queues all the tokens found in it. Both produce the same
+    tokens. The engine can be chosen per class or per instance
+    by setting the tokenizer attribute or calling set_tokenizer().
+
+    The parser takes either a file object, which is read in
+    BUFSIZ chunks, or a buffer (a string or an mmap object),
+    which is tokenized in place. In the latter case seeking
+    only moves the current position within the buffer.
     '''
     BUFSIZ = 4096
+    # the initial scan window of the regex engine.
+    REGEX_WINDOW = 256
+    # the keywords the regex engine does not scan past, because
+    # what follows is not tokenized (e.g. the body of a PDF stream)
+    # or is seldom read (e.g. after an indirect object).
+    REGEX_STOPWORDS = frozenset()
+
+    TOKENIZERS = ('statemachine', 'regex')
+    tokenizer = 'statemachine'
 
     debug = 0
 
+    BUFFER_TYPES = (str, mmap.mmap)
+
     def __init__(self, fp):
-        self.fp = fp
+        if isinstance(fp, self.BUFFER_TYPES):
+            self.fp = None
+            self.data = fp
+        else:
+            self.fp = fp
+            self.data = None
         self.seek(0)
         return
 
     def __repr__(self):
         return '<%s: %r, bufpos=%d>' % (self.__class__.__name__, self.fp, self.bufpos)
 
+    def set_tokenizer(self, tokenizer):
+        '''
+        Selects the tokenizer engine used by this parser.
+        '''
+        if tokenizer not in self.TOKENIZERS:
+            raise PSValueError('Unknown tokenizer: %r' % tokenizer)
+        self.tokenizer = tokenizer
+        return
+
     def flush(self):
         return
 
@@ -166,13 +226,23 @@ class PSBaseParser(object):
         return self.bufpos+self.charpos
 
     def poll(self, pos=None, n=80):
-        pos0 = self.fp.tell()
         if not pos:
             pos = self.bufpos+self.charpos
+        print >>stderr, 'poll(%d): %r' % (pos, self.fetch(pos, n))
+        return
+
+    def fetch(self, pos, n):
+        '''
+        Reads n bytes at the given position.
+        The parser position is not changed.
+        '''
+        if self.data is not None:
+            return self.data[pos:pos+n]
+        pos0 = self.fp.tell()
         self.fp.seek(pos)
-        print >>stderr, 'poll(%d): %r' % (pos, self.fp.read(n))
+        data = self.fp.read(n)
         self.fp.seek(pos0)
-        return
+        return data
 
     def seek(self, pos):
         '''
@@ -180,20 +250,35 @@ class PSBaseParser(object):
         '''
         if 2 <= self.debug:
             print >>stderr, 'seek: %r' % pos
-        self.fp.seek(pos)
         # reset the status for nextline()
-        self.bufpos = pos
-        self.buf = ''
-        self.charpos = 0
+        if self.data is not None:
+            # the whole buffer is always available.
+            self.bufpos = 0
+            self.buf = self.data
+            self.charpos = pos
+        else:
+            self.fp.seek(pos)
+            self.bufpos = pos
+            self.buf = ''
+            self.charpos = 0
+        self._reset_tokenizer()
+        return
+
+    def _reset_tokenizer(self):
         # reset the status for nexttoken()
         self._parse1 = self._parse_main
         self._curtoken = ''
         self._curtokenpos = 0
         self._tokens = []
+        # reset the status for the regex engine.
+        self._rtokens = []
+        self._rwindow = self.REGEX_WINDOW
         return
 
     def fillbuf(self):
         if self.charpos < len(self.buf): return
+        if self.data is not None:
+            raise PSEOF('Unexpected EOF')
         # fetch next chunk.
         self.bufpos = self.fp.tell()
         self.buf = self.fp.read(self.BUFSIZ)
@@ -206,6 +291,8 @@ class PSBaseParser(object):
         '''
         Fetches a next line that ends either with \\r or \\n.
         '''
+        # tokens queued by the regex engine are no longer valid.
+        self._rtokens = []
         linebuf = ''
         linepos = self.bufpos + self.charpos
         eol = False
@@ -238,6 +325,15 @@ class PSBaseParser(object):
         Fetches a next line backword. This is used to locate
         the trailers at the end of a file.
         '''
+        if self.data is not None:
+            data = self.data
+            pos = len(data)
+            while 0 < pos:
+                n = max(data.rfind('\r', 0, pos), data.rfind('\n', 0, pos))
+                if n == -1: break
+                yield data[n:pos]
+                pos = n
+            return
         self.fp.seek(0, 2)
         pos = self.fp.tell()
         buf = ''
@@ -438,6 +534,8 @@ class PSBaseParser(object):
         return (self._parse_main, j)
 
     def nexttoken(self):
+        if self.tokenizer == 'regex':
+            return self._nexttoken_regex()
         while not self._tokens:
             self.fillbuf()
             (self._parse1, self.charpos) = self._parse1(self.buf, self.charpos)
@@ -446,6 +544,150 @@ class PSBaseParser(object):
             print >>stderr, 'nexttoken: %r' % (token,)
         return token
 
+    # The regex engine.
+    def _extendbuf(self):
+        '''
+        Appends the next chunk to the unconsumed part of the buffer.
+        The new chunk is at least as large as the carried part so
+        that a token spanning many chunks is scanned in linear time.
+        '''
+        rest = self.buf[self.charpos:]
+        chunks = [rest]
+        size = 0
+        while size <= len(rest):
+            self.charpos = len(self.buf)
+            try:
+                self.fillbuf()
+            except PSEOF:
+                if size: break
+                raise
+            if not size:
+                bufpos = self.bufpos
+            chunks.append(self.buf)
+            size += len(self.buf)
+        self.bufpos = bufpos-len(rest)
+        self.buf = ''.join(chunks)
+        self.charpos = 0
+        return
+
+    def _scan_string(self, s, i, n):
+        '''
+        Scans a string literal that begins at s[i].
+        Returns (token, end), or None if it is not terminated in s[:n].
+        '''
+        paren = 1
+        token = []
+        while 1:
+            m = END_STRING.search(s, i, n)
+            if not m: return None
+            j = m.start(0)
+            token.append(s[i:j])
+            c = s[j]
+            if c == '\\':
+                m = ESC_SEQ.match(s, j+1, n)
+                if not m or m.end(0) == n: return None
+                esc = m.group(0)
+                if OCT_STRING.match(esc):
+                    token.append(chr(int(esc, 8)))
+                elif esc in ESC_STRING:
+                    token.append(chr(ESC_STRING[esc]))
+                i = m.end(0)
+            elif c == '(':
+                paren += 1
+                token.append(c)
+                i = j+1
+            else:
+                paren -= 1
+                if not paren: break
+                token.append(c)
+                i = j+1
+        return (''.join(token), j+1)
+
+    def _tokenize(self):
+        '''
+        Tokenizes the buffer from the current position in one pass.
+        The scan is limited to a window, which starts at REGEX_WINDOW
+        bytes after a seek and doubles with every pass, so that
+        a few tokens read after a seek (e.g. one object of a file)
+        do not cost a scan of the whole buffer. The scan stops
+        before a token that might continue beyond the window.
+        The scan also stops after one of REGEX_STOPWORDS.
+        Returns True if the window reached the end of the buffer.
+        '''
+        s = self.buf
+        i = self.charpos
+        n = min(len(s), i+self._rwindow)
+        tokens = []
+        while i < n:
+            m = TOKEN.match(s, i, n)
+            kind = m.lastgroup
+            j = m.end(0)
+            if j == n and kind in TOKEN_NEEDS_LOOKAHEAD: break
+            pos = self.bufpos+i
+            if kind == 'space' or kind == 'comment':
+                pass
+            elif kind == 'literal':
+                name = m.group(0)[1:]
+                if '#' in name:
+                    name = LITERAL_HEX.sub(lambda m: m.group(1) and chr(int(m.group(1), 16)), name)
+                tokens.append((pos, LIT(name), j))
+            elif kind == 'number' or kind == 'float':
+                x = m.group(0)
+                try:
+                    if '.' in x:
+                        tokens.append((pos, float(x), j))
+                    else:
+                        tokens.append((pos, int(x), j))
+                except ValueError:
+                    pass
+            elif kind == 'keyword':
+                x = m.group(0)
+                if x == 'true':
+                    token = True
+                elif x == 'false':
+                    token = False
+                else:
+                    token = KWD(x)
+                tokens.append((pos, token, j))
+                if x in self.REGEX_STOPWORDS:
+                    i = j
+                    break
+            elif kind == 'string':
+                x = self._scan_string(s, j, n)
+                if x is None: break
+                (token, j) = x
+                tokens.append((pos, token, j))
+            elif kind == 'dictbegin':
+                tokens.append((pos, KEYWORD_DICT_BEGIN, j))
+            elif kind == 'hexstring':
+                token = HEX_PAIR.sub(lambda m: chr(int(m.group(0), 16)),
+                                     SPC.sub('', m.group(0)[1:]))
+                tokens.append((pos, token, j))
+            elif kind == 'dictend':
+                tokens.append((pos, KEYWORD_DICT_END, j))
+            elif kind == 'wopen' or kind == 'wclose':
+                pass
+            else:
+                tokens.append((pos, KWD(m.group(0)), j))
+            i = j
+        if not tokens:
+            self.charpos = i
+        if not tokens or self._rwindow < self.BUFSIZ:
+            self._rwindow *= 2
+        tokens.reverse()
+        self._rtokens = tokens
+        return (n == len(s))
+
+    def _nexttoken_regex(self):
+        while not self._rtokens:
+            if self._tokenize() and not self._rtokens:
+                self._extendbuf()
+        (pos, token, self.charpos) = self._rtokens.pop()
+        token = (pos, token)
+        if 2 <= self.debug:
+            print >>stderr, 'nexttoken: %r' % (token,)
+        return token
+
 
 ##  PSStackParser
 ##
@@ -563,24 +805,24 @@ import unittest
 class TestPSBaseParser(unittest.TestCase):
 
     TESTDATA = r'''%!PS
-  begin end
-   "  @ #
-  /a/BCD /Some_Name /foo#5f#xbaa
-  0 +1 -2 .5 1.234
-  (abc) () (abc ( def ) ghi)
-  (def\040\0\0404ghi) (bach\\slask) (foo\nbaa)
-  (this % is not a comment.)
-  (foo
-  baa)
-  (foo\
-  baa)
-  <20> < 40 4020 >
-  <abcd00
-  12345>
-  func/a/b{(c)do*}def
-  [ 1 (z) ! ]
-  << /foo (bar) >>
-  '''
+begin end
+ "  @ #
+/a/BCD /Some_Name /foo#5f#xbaa
+0 +1 -2 .5 1.234
+(abc) () (abc ( def ) ghi)
+(def\040\0\0404ghi) (bach\\slask) (foo\nbaa)
+(this % is not a comment.)
+(foo
+baa)
+(foo\
+baa)
+<20> < 40 4020 >
+<abcd00
+12345>
+func/a/b{(c)do*}def
+[ 1 (z) ! ]
+<< /foo (bar) >>
+'''
 
     TOKENS = [
       (5, KWD('begin')), (11, KWD('end')), (16, KWD('"')), (19, KWD('@')),
@@ -608,12 +850,20 @@ class TestPSBaseParser(unittest.TestCase):
       (255, {'foo': 'bar'}),
       ]
 
-    def get_tokens(self, s):
+    def get_tokens(self, s, tokenizer='statemachine', bufsiz=PSBaseParser.BUFSIZ, inplace=False,
+                   window=PSBaseParser.REGEX_WINDOW, stopwords=()):
         import StringIO
         class MyParser(PSBaseParser):
+            BUFSIZ = bufsiz
+            REGEX_WINDOW = window
+            REGEX_STOPWORDS = frozenset(stopwords)
             def flush(self):
                 self.add_results(*self.popall())
-        parser = MyParser(StringIO.StringIO(s))
+        if inplace:
+            parser = MyParser(s)
+        else:
+            parser = MyParser(StringIO.StringIO(s))
+        parser.set_tokenizer(tokenizer)
         r = []
         try:
             while 1:
@@ -648,4 +898,49 @@ class TestPSBaseParser(unittest.TestCase):
         self.assertEqual(objs, self.OBJS)
         return
 
+    def test_3(self):
+        tokens = self.get_tokens(self.TESTDATA, tokenizer='regex')
+        self.assertEqual(tokens, self.TOKENS)
+        # tokens crossing chunk boundaries.
+        for bufsiz in (1, 2, 3, 7, 64):
+            tokens = self.get_tokens(self.TESTDATA, tokenizer='regex', bufsiz=bufsiz)
+            self.assertEqual(tokens, self.TOKENS)
+        return
+
+    def test_4(self):
+        # tokenize a buffer in place.
+        for tokenizer in PSBaseParser.TOKENIZERS:
+            tokens = self.get_tokens(self.TESTDATA, tokenizer=tokenizer, inplace=True)
+            self.assertEqual(tokens, self.TOKENS)
+        return
+
+    def test_5(self):
+        # tokens crossing the scan windows of the regex engine.
+        for window in (1, 2, 3, 7, 64):
+            for inplace in (False, True):
+                tokens = self.get_tokens(self.TESTDATA, tokenizer='regex',
+                                         inplace=inplace, window=window)
+                self.assertEqual(tokens, self.TOKENS)
+        # read a token after seeking to each of the tokens.
+        import StringIO
+        for inplace in (False, True):
+            if inplace:
+                parser = PSBaseParser(self.TESTDATA)
+            else:
+                parser = PSBaseParser(StringIO.StringIO(self.TESTDATA))
+            parser.set_tokenizer('regex')
+            for token in self.TOKENS:
+                parser.seek(token[0])
+                self.assertEqual(parser.nexttoken(), token)
+        return
+
+    def test_6(self):
+        # the regex engine stops scanning after a stopword.
+        for window in (3, 64, 4096):
+            for inplace in (False, True):
+                tokens = self.get_tokens(self.TESTDATA, tokenizer='regex', inplace=inplace,
+                                         window=window, stopwords=('end', 'func', 'def'))
+                self.assertEqual(tokens, self.TOKENS)
+        return
+
 if __name__ == '__main__': unittest.main()
@@ -25,25 +25,40 @@ def rldecode(data):
     >>> rldecode(s)
     '1234567777777abcde'
     """
-    decoded = []
-    i=0
-    while i < len(data):
-        #print "data[%d]=:%d:" % (i,ord(data[i]))
-        length = ord(data[i])
-        if length == 128:
-            break
-        if length >= 0 and length < 128:
-            run = data[i+1:(i+1)+(length+1)]
-            #print "length=%d, run=%s" % (length+1,run)
-            decoded.append(run)
-            i = (i+1) + (length+1)
-        if length > 128:
-            run = data[i+1]*(257-length)
-            #print "length=%d, run=%s" % (257-length,run)
-            decoded.append(run)
-            i = (i+1) + 1
-    return ''.join(decoded)
+    return ''.join(iter_rldecode([data]))
 
+def iter_rldecode(chunks):
+    """
+    Decodes an iterable of RunLength-encoded strings incrementally.
+    A run may span several chunks.
+    >>> list(iter_rldecode(["\x05123", "456\xfa", "7\x04abcde\x80junk"]))
+    ['', '123456', '7777777abcde']
+    """
+    rest = ''
+    for data in chunks:
+        data = rest+data
+        decoded = []
+        i = 0
+        while i < len(data):
+            length = ord(data[i])
+            if length == 128:
+                yield ''.join(decoded)
+                return
+            if length < 128:
+                j = (i+1) + (length+1)
+                if len(data) < j: break
+                decoded.append(data[i+1:j])
+                i = j
+            else:
+                if len(data) < i+2: break
+                decoded.append(data[i+1]*(257-length))
+                i = (i+1) + 1
+        rest = data[i:]
+        yield ''.join(decoded)
+    if rest and ord(rest[0]) < 128:
+        # a truncated literal run.
+        yield rest[1:]
+    return
 
 if __name__ == '__main__':
     import doctest
@@ -167,10 +167,169 @@ class ObjIdRange(object):
         return self.nobjs
 
 
+##  LRUCache
+##
+class LRUCache(object):
+
+    """A dictionary-like cache that discards the least recently used entries.
+
+    The cache is bounded by the number of entries (maxentries) and
+    the total size of the entries (maxbytes), whichever is reached
+    first. Zero means no limit. The size of each entry is estimated
+    by sizefunc when it is stored.
+
+    A pinned key is never evicted and is not counted toward
+    the limits. The cache counts hits, misses and evictions.
+
+    >>> cache = LRUCache(maxentries=2)
+    >>> cache.pin('a')
+    >>> cache['a'] = 1; cache['b'] = 2; cache['c'] = 3
+    >>> cache['b']
+    2
+    >>> cache['d'] = 4
+    >>> sorted( k for k in 'abcd' if k in cache )
+    ['a', 'b', 'd']
+    >>> (cache.hits, cache.evictions)
+    (1, 1)
+    """
+
+    # Each entry is kept in a link of a circular list:
+    # [prev, next, key, value, size]
+
+    def __init__(self, maxentries=0, maxbytes=0, sizefunc=None):
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.sizefunc = sizefunc
+        self.pinkeys = set()
+        self.clear()
+        self.reset_stats()
+        return
+
+    def __repr__(self):
+        return ('<LRUCache: entries=%d, bytes=%d, pinned=%d>' %
+                (len(self.links), self.nbytes, len(self.pinned)))
+
+    def clear(self):
+        self.pinned = {}
+        self.links = {}
+        # a circular list of the links; root[NEXT] is the oldest.
+        self.root = root = []
+        root[:] = [root, root, None, None, 0]
+        self.nbytes = 0
+        return
+
+    def reset_stats(self):
+        self.hits = self.misses = self.evictions = 0
+        return
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self.links),
+                'bytes': self.nbytes, 'pinned': len(self.pinned)}
+
+    def __len__(self):
+        return len(self.links)+len(self.pinned)
+
+    def __contains__(self, key):
+        return key in self.links or key in self.pinned
+
+    def __getitem__(self, key):
+        if key in self.pinned:
+            self.hits += 1
+            return self.pinned[key]
+        try:
+            link = self.links[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        # move the link to the newest end.
+        (prev, next) = (link[0], link[1])
+        prev[1] = next
+        next[0] = prev
+        root = self.root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0] = last
+        link[1] = root
+        return link[3]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        if key in self.pinkeys:
+            self.pinned[key] = value
+            return
+        if key in self.links:
+            self.unlink(key)
+        size = 0
+        if self.sizefunc is not None:
+            size = self.sizefunc(value)
+        root = self.root
+        last = root[0]
+        link = [last, root, key, value, size]
+        last[1] = root[0] = self.links[key] = link
+        self.nbytes += size
+        self.shrink()
+        return
+
+    def __delitem__(self, key):
+        if key in self.pinned:
+            del self.pinned[key]
+        else:
+            self.unlink(key)
+        return
+
+    def unlink(self, key):
+        link = self.links.pop(key)
+        (prev, next) = (link[0], link[1])
+        prev[1] = next
+        next[0] = prev
+        self.nbytes -= link[4]
+        return link
+
+    def shrink(self):
+        root = self.root
+        # the newest entry is always kept.
+        while 1 < len(self.links) and (
+            (self.maxentries and self.maxentries < len(self.links)) or
+            (self.maxbytes and self.maxbytes < self.nbytes)):
+            self.unlink(root[1][2])
+            self.evictions += 1
+        return
+
+    def pin(self, key):
+        "Keeps the entry of the key (stored now or later) from being evicted."
+        if key in self.pinkeys: return
+        self.pinkeys.add(key)
+        if key in self.links:
+            self.pinned[key] = self.unlink(key)[3]
+        return
+
+    def unpin(self, key):
+        if key not in self.pinkeys: return
+        self.pinkeys.discard(key)
+        if key in self.pinned:
+            self[key] = self.pinned.pop(key)
+        return
+
+
+# create_bmp_header
+def create_bmp_header(datasize, bits, width, height):
+    info = pack('<IiiHHIIIIII', 40, width, height, 1, bits, 0, datasize, 0, 0, 0, 0)
+    assert len(info) == 40, len(info)
+    header = pack('<ccIHHI', 'B', 'M', 14+40+datasize, 0, 0, 14+40)
+    return header+info
+
 # create_bmp
 def create_bmp(data, bits, width, height):
-    info = pack('<IiiHHIIIIII', 40, width, height, 1, bits, 0, len(data), 0, 0, 0, 0)
-    assert len(info) == 40, len(info)
-    header = pack('<ccIHHI', 'B', 'M', 14+40+len(data), 0, 0, 14+40)
     # XXX re-rasterize every line
-    return header+info+data
+    return create_bmp_header(len(data), bits, width, height)+data
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
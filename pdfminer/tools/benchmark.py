@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+#
+# benchmark.py - measure the throughput of pdfminer components.
+#
+#  usage: benchmark.py [-n repeat] target file ...
+#  targets:
+#    tokenizer : compare the tokenizer engines on the decoded content streams
+#                of each page, as PDFContentParser reads them.
+#    objects   : resolve every object of a document with each tokenizer engine,
+#                reading from a file and from an mmap.
+#    firstpage : time to read the xrefs, open the document and render the first page.
+#    aes       : decrypt the file contents as an AES encrypted stream.
+#    lzw       : decode the file contents compressed with LZW.
+#    interp    : interpret all the pages with a null device (operator throughput),
+#                with and without parsing the content streams, dispatching the
+#                operators by name for each keyword (as before the lookup
+#                table) and through the lookup table.
+#
+import sys, os, time, mmap
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+from pdfminer.psparser import PSBaseParser, PSEOF, PSKeyword, keyword_name
+from pdfminer.pdfparser import PDFDocument, PDFParser
+from pdfminer.pdftypes import PDFException, PDFStream, stream_value
+from pdfminer import pdfinterp
+from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter, PDFContentParser
+from pdfminer.pdfdevice import PDFDevice
+from pdfminer.converter import TextConverter
+from pdfminer.layout import LAParams
+from pdfminer.rijndael import RijndaelEncryptor, RijndaelDecryptor
+from pdfminer.lzw import LZWDecoder, iter_lzwdecode
+
+
+# timeit
+def timeit(func, repeat=3):
+    '''Returns the best time of several runs and the result of the last one.'''
+    best = None
+    for _ in xrange(repeat):
+        t0 = time.time()
+        result = func()
+        t = time.time()-t0
+        if best is None or t < best:
+            best = t
+    return (best, result)
+
+def report(out, name, t, nbytes, nitems, unit):
+    out.write('  %-16s %8.3f sec  %8.2f MB/s  %10d %s/s\n' %
+              (name, t, nbytes/t/1048576.0, nitems/t, unit))
+    return
+
+
+# bench_tokenizer
+def bench_tokenizer(out, fname, repeat=3):
+    fp = file(fname, 'rb')
+    parser = PDFParser(fp)
+    doc = PDFDocument()
+    parser.set_document(doc)
+    doc.set_parser(parser)
+    doc.initialize('')
+    # the content streams are decoded beforehand, so that
+    # only the tokenization is timed.
+    pages = [ [ PDFStream({}, stream_value(x).get_data()) for x in page.contents ]
+              for page in doc.get_pages() ]
+    fp.close()
+    nbytes = sum( len(strm.get_data()) for streams in pages for strm in streams )
+    def tokenize(tokenizer):
+        tokens = []
+        for streams in pages:
+            parser = PDFContentParser(streams)
+            parser.set_tokenizer(tokenizer)
+            while 1:
+                try:
+                    tokens.append(parser.nexttoken())
+                except PSEOF:
+                    break
+                except ValueError:
+                    # the state machine fails at a malformed number,
+                    # which the regex engine skips. resume after it.
+                    parser.seek(parser.tell())
+        return tokens
+    out.write('%s: %d pages, %d bytes\n' % (fname, len(pages), nbytes))
+    results = []
+    for tokenizer in PSBaseParser.TOKENIZERS:
+        (t, tokens) = timeit(lambda: tokenize(tokenizer), repeat)
+        report(out, tokenizer, t, nbytes, len(tokens), 'tokens')
+        results.append((tokenizer, t, tokens))
+    ((name0, t0, tokens0), (name1, t1, tokens1)) = results[:2]
+    if tokens0 != tokens1:
+        out.write('  WARNING: %s and %s produced different tokens!\n' % (name0, name1))
+    out.write('  %s/%s time: %.2f\n' % (name1, name0, t1/t0))
+    return
+
+
+# bench_objects
+def bench_objects(out, fname, repeat=3):
+    fp = file(fname, 'rb')
+    size = os.fstat(fp.fileno()).st_size
+    def resolve(source, tokenizer):
+        # the tokenizer is set on the class so that the parsers
+        # of the object streams also use it.
+        default = PSBaseParser.tokenizer
+        PSBaseParser.tokenizer = tokenizer
+        try:
+            if source == 'mmap':
+                parser = PDFParser(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+            else:
+                fp.seek(0)
+                parser = PDFParser(fp)
+            doc = PDFDocument()
+            parser.set_document(doc)
+            doc.set_parser(parser)
+            doc.initialize('')
+            objs = []
+            for xref in doc.xrefs:
+                for objid in xref.get_objids():
+                    try:
+                        objs.append((objid, repr(doc.getobj(objid))))
+                    except PDFException:
+                        pass
+        finally:
+            PSBaseParser.tokenizer = default
+        return objs
+    out.write('%s: %d bytes\n' % (fname, size))
+    for source in ('file', 'mmap'):
+        results = []
+        for tokenizer in PSBaseParser.TOKENIZERS:
+            (t, objs) = timeit(lambda: resolve(source, tokenizer), repeat)
+            report(out, '%s/%s' % (source, tokenizer), t, size, len(objs), 'objs')
+            results.append(objs)
+        if results[0] != results[1]:
+            out.write('  WARNING: the objects differ!\n')
+    fp.close()
+    return
+
+
+# bench_firstpage
+def bench_firstpage(out, fname, repeat=3):
+    def read_xref():
+        fp = file(fname, 'rb')
+        parser = PDFParser(fp)
+        # xref streams need a document to construct PDFStream objects.
+        parser.set_document(PDFDocument())
+        xrefs = parser.read_xref()
+        fp.close()
+        return sum( len(list(xref.get_objids())) for xref in xrefs )
+    def open_doc():
+        fp = file(fname, 'rb')
+        parser = PDFParser(fp)
+        doc = PDFDocument()
+        parser.set_document(doc)
+        doc.set_parser(parser)
+        doc.initialize('')
+        return (fp, doc)
+    def first_page():
+        (fp, doc) = open_doc()
+        rsrc = PDFResourceManager()
+        device = TextConverter(rsrc, StringIO(), laparams=LAParams())
+        interpreter = PDFPageInterpreter(rsrc, device)
+        for page in doc.get_pages():
+            interpreter.process_page(page)
+            break
+        fp.close()
+        return
+    out.write('%s:\n' % fname)
+    (t, nobjs) = timeit(read_xref, repeat)
+    out.write('  %-16s %8.3f sec  (%d objects)\n' % ('read_xref', t, nobjs))
+    (t, (fp, _)) = timeit(open_doc, repeat)
+    fp.close()
+    out.write('  %-16s %8.3f sec\n' % ('open', t))
+    (t, _) = timeit(first_page, repeat)
+    out.write('  %-16s %8.3f sec\n' % ('first page', t))
+    return
+
+
+# bench_aes
+def bench_aes(out, fname, repeat=3):
+    data = file(fname, 'rb').read()
+    data += '\x00' * (-len(data) % 16)
+    iv = os.urandom(16)
+    def decrypt_blocks(aes, data):
+        # decrypt one block at a time.
+        blocks = []
+        prev = iv
+        for i in xrange(0, len(data), 16):
+            block = data[i:i+16]
+            blocks.append(''.join( chr(ord(a) ^ ord(b)) for (a,b) in zip(aes.decrypt(block), prev) ))
+            prev = block
+        return ''.join(blocks)
+    out.write('%s: %d bytes\n' % (fname, len(data)))
+    for keybits in (128, 256):
+        key = os.urandom(keybits/8)
+        ciphertext = RijndaelEncryptor(key, keybits).encrypt_cbc(iv, data)
+        aes = RijndaelDecryptor(key, keybits)
+        (t0, plain0) = timeit(lambda: decrypt_blocks(aes, ciphertext), repeat)
+        report(out, 'block-%d' % keybits, t0, len(data), len(data)/16, 'blocks')
+        (t1, plain1) = timeit(lambda: aes.decrypt_cbc(iv, ciphertext), repeat)
+        report(out, 'cbc-%d' % keybits, t1, len(data), len(data)/16, 'blocks')
+        if plain0 != data or plain1 != data:
+            out.write('  WARNING: decrypted data differ!\n')
+        out.write('  speedup: %.2fx\n' % (t0/t1))
+    return
+
+
+# lzwencode
+def lzwencode(data):
+    '''Compresses a string with LZW (EarlyChange=1).'''
+    codes = [(256, 9)]
+    table = dict( (chr(i), i) for i in xrange(256) )
+    (nextcode, nbits) = (258, 9)
+    w = ''
+    for c in data:
+        wc = w+c
+        if wc in table:
+            w = wc
+            continue
+        codes.append((table[w], nbits))
+        table[wc] = nextcode
+        nextcode += 1
+        if nextcode == 4096:
+            # clear the table when it is full.
+            codes.append((256, 12))
+            table = dict( (chr(i), i) for i in xrange(256) )
+            (nextcode, nbits) = (258, 9)
+        elif nextcode == (1 << nbits):
+            nbits += 1
+        w = c
+    if w:
+        codes.append((table[w], nbits))
+        if nextcode+1 == (1 << nbits):
+            nbits += 1
+    codes.append((257, nbits))
+    # pack the codes into bytes.
+    out = []
+    bitbuf = nbuf = 0
+    for (code, nbits) in codes:
+        bitbuf = (bitbuf << nbits) | code
+        nbuf += nbits
+        while 8 <= nbuf:
+            nbuf -= 8
+            out.append(chr((bitbuf >> nbuf) & 255))
+        bitbuf &= (1 << nbuf)-1
+    if nbuf:
+        out.append(chr((bitbuf << (8-nbuf)) & 255))
+    return ''.join(out)
+
+# bench_lzw
+def bench_lzw(out, fname, repeat=3):
+    data = file(fname, 'rb').read()
+    encoded = lzwencode(data)
+    out.write('%s: %d bytes (%d bytes encoded)\n' % (fname, len(data), len(encoded)))
+    (t0, data0) = timeit(lambda: ''.join(LZWDecoder(StringIO(encoded)).run()), repeat)
+    report(out, 'LZWDecoder', t0, len(data), len(encoded), 'bytes')
+    (t1, data1) = timeit(lambda: ''.join(iter_lzwdecode([encoded])), repeat)
+    report(out, 'iter_lzwdecode', t1, len(data), len(encoded), 'bytes')
+    if data0 != data or data1 != data:
+        out.write('  WARNING: decoded data differ!\n')
+    out.write('  speedup: %.2fx\n' % (t0/t1))
+    return
+
+# bench_interp
+class ReplayParser(object):
+    '''Replays the objects of content streams parsed beforehand.'''
+    objs = {}
+    def __init__(self, streams, images=True):
+        try:
+            self.objs = iter(self.objs[id(streams)])
+        except KeyError:
+            # forms are parsed as usual.
+            self.objs = iter(parse_contents(streams))
+        return
+    def nextobject(self):
+        try:
+            return self.objs.next()
+        except StopIteration:
+            raise PSEOF
+
+def parse_contents(streams):
+    objs = []
+    try:
+        parser = PDFContentParser(streams)
+        while 1:
+            objs.append(parser.nextobject())
+    except PSEOF:
+        pass
+    return objs
+
+class NameDispatchInterpreter(PDFPageInterpreter):
+    '''Looks up the method of each operator by its name every time.'''
+    def dup(self):
+        return NameDispatchInterpreter(self.rsrc, self.device)
+    def execute(self, streams, reuse=False):
+        try:
+            parser = pdfinterp.PDFContentParser(streams)
+        except PSEOF:
+            return
+        while 1:
+            try:
+                (_,obj) = parser.nextobject()
+            except PSEOF:
+                break
+            if isinstance(obj, PSKeyword):
+                name = keyword_name(obj)
+                method = 'do_%s' % name.replace('*','_a').replace('"','_w').replace("'",'_q')
+                if hasattr(self, method):
+                    func = getattr(self, method)
+                    nargs = func.func_code.co_argcount-1
+                    if nargs:
+                        args = self.pop(nargs)
+                        if len(args) == nargs:
+                            func(*args)
+                    else:
+                        func()
+            else:
+                self.push(obj)
+        return
+
+def bench_interp(out, fname, repeat=3):
+    fp = file(fname, 'rb')
+    parser = PDFParser(fp)
+    doc = PDFDocument()
+    parser.set_document(doc)
+    doc.set_parser(parser)
+    doc.initialize('')
+    pages = list(doc.get_pages())
+    # parse the page contents (excluding forms) and count the operators.
+    nops = nbytes = 0
+    for page in pages:
+        nbytes += sum( len(stream_value(x).get_data()) for x in page.contents )
+        objs = ReplayParser.objs[id(page.contents)] = parse_contents(page.contents)
+        nops += sum( 1 for (_,obj) in objs if isinstance(obj, PSKeyword) )
+    # the fonts are loaded once and shared by the runs.
+    rsrc = PDFResourceManager()
+    def interpret(klass):
+        interpreter = klass(rsrc, PDFDevice(rsrc))
+        for page in pages:
+            interpreter.process_page(page)
+        return
+    def execute(klass):
+        pdfinterp.PDFContentParser = ReplayParser
+        try:
+            interpret(klass)
+        finally:
+            pdfinterp.PDFContentParser = PDFContentParser
+        return
+    out.write('%s: %d pages, %d operators\n' % (fname, len(pages), nops))
+    interpret(PDFPageInterpreter)
+    for (name, klass) in (('names', NameDispatchInterpreter),
+                          ('table', PDFPageInterpreter)):
+        (t, _) = timeit(lambda: interpret(klass), repeat)
+        report(out, 'parse+exec/%s' % name, t, nbytes, nops, 'ops')
+        (t, _) = timeit(lambda: execute(klass), repeat)
+        report(out, 'exec/%s' % name, t, nbytes, nops, 'ops')
+    ReplayParser.objs.clear()
+    fp.close()
+    return
+
+
+BENCHMARKS = {
+    'tokenizer': bench_tokenizer,
+    'objects': bench_objects,
+    'firstpage': bench_firstpage,
+    'aes': bench_aes,
+    'lzw': bench_lzw,
+    'interp': bench_interp,
+    }
+
+# main
+def main(argv):
+    import getopt
+    def usage():
+        print 'usage: %s [-n repeat] {%s} file ...' % (argv[0], '|'.join(sorted(BENCHMARKS)))
+        return 100
+    try:
+        (opts, args) = getopt.getopt(argv[1:], 'n:')
+    except getopt.GetoptError:
+        return usage()
+    if len(args) < 2: return usage()
+    repeat = 3
+    for (k, v) in opts:
+        if k == '-n': repeat = int(v)
+    target = args.pop(0)
+    if target not in BENCHMARKS: return usage()
+    bench = BENCHMARKS[target]
+    for fname in args:
+        bench(sys.stdout, fname, repeat=repeat)
+    return
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
@@ -1,22 +1,85 @@
 #!/usr/bin/env python
 import sys
+import os.path
 from pdfminer.pdfparser import PDFDocument, PDFParser
 from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter, process_pdf
+from pdfminer.pdfparallel import DeviceFactory, process_pdf_parallel, process_pdf_batch
+from pdfminer.pdfparallel import PDFWorkerTimeout
 from pdfminer.pdfdevice import PDFDevice
 from pdfminer.converter import XMLConverter, HTMLConverter, TextConverter, TagExtractor
 from pdfminer.cmapdb import CMapDB
 from pdfminer.layout import LAParams
 
+# batch
+#   Converts each file into batchdir with worker processes, and writes
+#   the status, elapsed time, number of pages and error of each file
+#   to batchdir/manifest.txt. An argument that starts with '@' is
+#   a file that lists the files to convert, one for each line.
+#   Returns 1 if any file has failed.
+OUTPUT_EXTS = { 'text': '.txt', 'xml': '.xml', 'html': '.html', 'tag': '.tag' }
+def batch(factory, args, batchdir, outtype, pagenos, maxpages, password, cachedir,
+          nworkers, timeout, maxtasks):
+    fnames = []
+    for arg in args:
+        if arg.startswith('@'):
+            fp = file(arg[1:])
+            fnames.extend( line.strip() for line in fp if line.strip() )
+            fp.close()
+        else:
+            fnames.append(arg)
+    if not os.path.isdir(batchdir):
+        os.makedirs(batchdir)
+    # files with the same name get different outputs.
+    ext = OUTPUT_EXTS[outtype]
+    names = set(['manifest'])
+    files = []
+    for fname in fnames:
+        name = base = os.path.splitext(os.path.basename(fname))[0]
+        i = 1
+        while name in names:
+            name = '%s-%d' % (base, i)
+            i += 1
+        names.add(name)
+        files.append((fname, os.path.join(batchdir, name+ext)))
+    manifest = file(os.path.join(batchdir, 'manifest.txt'), 'w')
+    manifest.write('# status\tseconds\tpages\tinput\toutput\terror\n')
+    nfailed = 0
+    results = process_pdf_batch(factory, files, pagenos=pagenos, maxpages=maxpages,
+                                password=password, cachedir=cachedir,
+                                nworkers=(nworkers or None), timeout=timeout, maxtasks=maxtasks)
+    for (fname, outpath, npages, elapsed, error) in results:
+        if error is None:
+            status = 'ok'
+        elif error.startswith(PDFWorkerTimeout.__name__+':'):
+            status = 'timeout'
+        else:
+            status = 'error'
+        if error is not None:
+            nfailed += 1
+            print >>sys.stderr, '%s: %s' % (fname, error)
+        if elapsed is None:
+            elapsed = '-'
+        else:
+            elapsed = '%.3f' % elapsed
+        manifest.write('%s\t%s\t%d\t%s\t%s\t%s\n' %
+                       (status, elapsed, npages, fname, outpath,
+                        ' '.join((error or '').split())))
+        # the manifest is kept up to date in case the batch is interrupted.
+        manifest.flush()
+    manifest.close()
+    return (nfailed and 1)
+
 # main
 def main(argv):
     import getopt
     def usage():
         print ('usage: %s [-d] [-p pagenos] [-m maxpages] [-P password] [-o output] '
                '[-n] [-A] [-D writing_mode] [-M char_margin] [-L line_margin] [-W word_margin] '
-               '[-O output_dir] [-t text|html|xml|tag] [-c codec] [-s scale] file ...' % argv[0])
+               '[-O output_dir] [-t text|html|xml|tag] [-c codec] [-s scale] [-C cachedir] [-j jobs] '
+               '[-b batch_dir] [-T timeout] [-R recycle] file ...' % argv[0])
         return 100
     try:
-        (opts, args) = getopt.getopt(argv[1:], 'dp:m:P:o:nAD:M:L:W:O:t:c:s:')
+        (opts, args) = getopt.getopt(argv[1:], 'dp:m:P:o:nAD:M:L:W:O:t:c:s:C:j:b:T:R:')
     except getopt.GetoptError:
         return usage()
     if not args: return usage()
@@ -24,7 +87,13 @@ def main(argv):
     debug = 0
     # input option
     password = ''
+    cachedir = None
+    nworkers = 1
     pagenos = set()
+    # batch option
+    batchdir = None
+    timeout = 600
+    maxtasks = 100
     maxpages = 0
     # output option
     outfile = None
@@ -51,6 +120,11 @@ def main(argv):
         elif k == '-t': outtype = v
         elif k == '-c': codec = v
         elif k == '-s': scale = float(v)
+        elif k == '-C': cachedir = v
+        elif k == '-j': nworkers = int(v)
+        elif k == '-b': batchdir = v
+        elif k == '-T': timeout = float(v)
+        elif k == '-R': maxtasks = int(v)
     #
     CMapDB.debug = debug
     PDFResourceManager.debug = debug
@@ -69,23 +143,35 @@ def main(argv):
                 outtype = 'xml'
             elif outfile.endswith('.tag'):
                 outtype = 'tag'
-    if outfile:
-        outfp = file(outfile, 'w')
-    else:
-        outfp = sys.stdout
+    # the factory also creates the devices of the worker processes.
     if outtype == 'text':
-        device = TextConverter(rsrc, outfp, codec=codec, laparams=laparams)
+        factory = DeviceFactory(TextConverter, codec=codec, laparams=laparams)
     elif outtype == 'xml':
-        device = XMLConverter(rsrc, outfp, codec=codec, laparams=laparams, outdir=outdir)
+        factory = DeviceFactory(XMLConverter, codec=codec, laparams=laparams, outdir=outdir)
     elif outtype == 'html':
-        device = HTMLConverter(rsrc, outfp, codec=codec, scale=scale, laparams=laparams, outdir=outdir)
+        factory = DeviceFactory(HTMLConverter, codec=codec, scale=scale, laparams=laparams, outdir=outdir)
     elif outtype == 'tag':
-        device = TagExtractor(rsrc, outfp, codec=codec)
+        factory = DeviceFactory(TagExtractor, codec=codec)
     else:
         return usage()
+    if batchdir:
+        return batch(factory, args, batchdir, outtype, pagenos, maxpages, password, cachedir,
+                     nworkers, timeout, maxtasks)
+    if outfile:
+        outfp = file(outfile, 'w')
+    else:
+        outfp = sys.stdout
+    device = factory(rsrc, outfp)
     for fname in args:
+        if nworkers != 1:
+            # -j 0 uses all the CPUs.
+            process_pdf_parallel(rsrc, device, factory, fname, outfp, pagenos,
+                                 maxpages=maxpages, password=password, cachedir=cachedir,
+                                 nworkers=(nworkers or None))
+            continue
         fp = file(fname, 'rb')
-        process_pdf(rsrc, device, fp, pagenos, maxpages=maxpages, password=password)
+        process_pdf(rsrc, device, fp, pagenos, maxpages=maxpages, password=password,
+                    cachedir=cachedir)
         fp.close()
     device.close()
     outfp.close()